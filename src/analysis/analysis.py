@@ -4,7 +4,11 @@
 This module called *analysis* does the *analysis step*.
 
 First, the module loads the data generated in the *data_management step*. These
-are the data that we are going to work with.
+are the data that we are going to work with. As in the *data_management step*, the
+multi-wave build passes the year of the wave as the first command line argument, and
+the inputs and outputs of that wave live in the subfolders *waves/<year>*. The optional
+second argument is the maximum number of processes of the pools of this module: the
+waves already run as parallel jobs, so each of them should not use all the cores.
 
 The module makes use repeatedly of functions stored in the *myfunctions.py*
 module, in the folder *functions*.
@@ -13,42 +17,124 @@ The main goal of this module is to generate gini coefficients, lorenz curves
 and households statistics along the income, and wealth distribution as well as over the 
 the life cycle to be passed to the *final step*, where tables and plots will be produced.
 
-The module can be broadly subdivided into three different parts.
+The module can be broadly subdivided into eight different parts.
 
   * Create population partitions: it divides the sample by income/wealth quintiles/deciles
-    and by age groups. To this end, it computes population PDFs and CDFs. After defining the
-    desired bins, it calls the function *generate_bins* that returns the partitions of the 
-    sample.
-
-  * Compute Gini and Lorenz Curve: using data from the previous part, it calls the function
-    *generate_gini* which returns the Gini coefficients and Lorenz curves for income and
-    wealth.
+    and by age groups. To this end, it computes population PDFs and CDFs. Each column is
+    sorted only once with *generate_sort_index*, and the permutations are reused everywhere.
+    After defining the desired bins, it calls the functions *generate_bins_batch* and
+    *generate_bins* that return the partitions of the sample. The percentiles P1...P99,
+    P99.9 and P99.99 of income and wealth, and the percentile ranks of some levels of net
+    worth, are read from the same CDFs with *generate_weighted_quantiles* and
+    *generate_percentile_ranks*.
+
+  * Compute Gini and Lorenz Curve: it calls the function *generate_gini_batch* which
+    returns the Gini coefficients and Lorenz curves for income and wealth in one call. All
+    the Lorenz curves are evaluated on a fixed grid of weighted population shares. The
+    top 10%, 1%, 0.1% and 0.01% shares come from the same cumulative shares with
+    *generate_top_shares*. The other inequality indices (Theil, mean log deviation,
+    Atkinson, generalized entropy, coefficient of variation and percentile ratios) come
+    from *generate_inequality_indices*. The Gini coefficients and Lorenz curves of net worth
+    within each age group and each employment status come from *generate_group_gini*.
+    The Theil index and the Gini coefficient are decomposed into within- and between-group
+    parts (and the overlap, for the Gini) by age group and employment status with
+    *generate_inequality_decomposition*.
+    The Gini coefficient of income is decomposed by income source with
+    *generate_source_decomposition*. The concentration indices and curves of net worth
+    ranked by income, and of debt and home equity ranked by net worth, come from
+    *generate_concentration*.
 
   * Compute averages by partition: using the partitions generated in the first part, it
     generates the averages of variables for each cell of the partition. That is, it will 
     compute what is the average income, net worth, debt... for age group, quantile/decile
-    of the income/wealth distribution and so on. It makes use of the function *generate_averages*.
-    Finally, it creates some new variables as ratios of previously defined variables. 
-
-
-Finally, it bundles all the data into a dataframe called *data_to_output* which contains the
-inputs for the *final step*.
+    of the income/wealth distribution and so on. Since every partition is a contiguous range
+    of a sorted frame, it builds the cumulative weighted sums once per sort order with
+    *generate_prefix_index* and reads the averages of each bin with *generate_bin_averages*.
+    The total averages come from *generate_averages*.
+    The population shares and averages of the cells of the joint income and net worth
+    deciles come from *generate_joint_distribution*.
+    Finally, it creates some new variables as ratios of previously defined variables
+    with *generate_ratios*.
+
+  * Multiple implicates: the survey stores five imputation replicates of each household.
+    The partitions and Gini coefficients are computed on each implicate in a pool of
+    processes with *generate_partition_statistics*, and combined with Rubin's rules
+    (*generate_rubin*) into point estimates and between-imputation variances.
+
+  * Standard errors: the averages of every partition and the Gini coefficients are computed
+    under all the replicate weights of the survey at once (*generate_replicate_averages*,
+    *generate_gini_replicates*). Their variance, plus the between-imputation variance,
+    gives the standard errors stored next to each table with the prefix *se_*.
+
+  * Histograms: it computes the weighted histograms of income and net worth, trimming the
+    top of the distributions, with *generate_histogram*. Only the counts and the edges are
+    passed to the *final step*.
+
+  * Kernel densities: it computes the weighted kernel densities of income, net worth and
+    their inverse hyperbolic sine, for the whole sample and by age group, with
+    *generate_kde*.
+
+  * Bootstrap confidence intervals: *generate_gini_bootstrap* re-draws the household
+    weights, with one draw per household shared by its five implicates, in a pool of
+    processes, keeping the sort order, and returns percentile intervals for the Gini
+    coefficients and for the Lorenz curves on a fixed grid of population shares.
+
+
+Finally, it bundles all the data into a dictionary called *data_to_output* which contains the
+inputs for the *final step*, and saves it as an artifact (see the module *mystorage*).
 
 """
 
 
 
+import sys
+from functools import partial
 from bld.project_paths import project_paths_join as ppj
 import pandas as pd
 import numpy as np
-import pickle as pkl
 from src.functions.myfunctions import generate_bins
-from src.functions.myfunctions import generate_densities
-from src.functions.myfunctions import generate_gini
+from src.functions.myfunctions import generate_bins_batch
+from src.functions.myfunctions import generate_ecdf
+from src.functions.myfunctions import generate_weighted_quantiles
+from src.functions.myfunctions import generate_percentile_ranks
+from src.functions.myfunctions import generate_sort_index
+from src.functions.myfunctions import generate_gini_batch
+from src.functions.myfunctions import generate_top_shares
+from src.functions.myfunctions import generate_inequality_indices
+from src.functions.myfunctions import generate_group_gini
+from src.functions.myfunctions import generate_inequality_decomposition
+from src.functions.myfunctions import generate_source_decomposition
+from src.functions.myfunctions import generate_concentration
 from src.functions.myfunctions import generate_averages
+from src.functions.myfunctions import generate_prefix_index
+from src.functions.myfunctions import generate_bin_averages
+from src.functions.myfunctions import generate_joint_distribution
+from src.functions.myfunctions import generate_ratios
+from src.functions.myfunctions import generate_partition_statistics
+from src.functions.myfunctions import generate_parallel_map
+from src.functions.myfunctions import generate_rubin
+from src.functions.myfunctions import generate_unsorted
+from src.functions.myfunctions import generate_replicate_averages
+from src.functions.myfunctions import generate_gini_replicates
+from src.functions.myfunctions import generate_replicate_variance
+from src.functions.myfunctions import generate_gini_bootstrap
+from src.functions.myfunctions import generate_histogram
+from src.functions.myfunctions import generate_kde
+from src.functions.mystorage import read_artifact, write_artifact, generate_sorted_view
+
+
+# -- Survey wave: see the data_management step.
+
+sfc_wave = sys.argv[1] if len(sys.argv) > 1 else None
+sfc_outdir = ('waves',sfc_wave) if sfc_wave else ()
 
+# -- Maximum number of processes (all the cores by default).
 
-sfc_clean_pd = pkl.load(open(ppj("OUT_DATA", "sfc_clean_pd.pkl"), "rb"))
+sfc_maxworkers = int(sys.argv[2]) if len(sys.argv) > 2 else None
+
+sfc_clean_artifact = read_artifact(ppj("OUT_DATA",*sfc_outdir,"sfc_clean_pd.artifact"))
+sfc_clean_pd = sfc_clean_artifact['sfc_clean_pd']
+sfc_replicate_weights = sfc_clean_artifact['sfc_replicate_weights']
 
 ###############################################################################
 # Create population partitions by net worth, income and age ###################
@@ -64,16 +150,22 @@ sample_nobs = len(sfc_clean_pd)
 
 
 
-# -- Weights as np array to pass to generage_densities function.
+# -- Weights as np array to pass to generate_ecdf function.
 weights_np = np.array(sfc_clean_pd['hh_weight'])
 
-# -- Index of sorted wealth and income. Required to create pdf and cdf.
-net_worth_index_sorted = np.argsort(np.array(sfc_clean_pd['net_worth']))
-income_total_index_sorted = np.argsort(np.array(sfc_clean_pd['income_total']))
+# -- Sort each column once. The permutations are kept in sort_cache and reused below by
+#    the densities, the sorted dataframes and the Gini coefficients.
+sort_cache = {}
+net_worth_index_sorted = generate_sort_index(sfc_clean_pd,'net_worth',sort_cache)
+income_total_index_sorted = generate_sort_index(sfc_clean_pd,'income_total',sort_cache)
+hh_age_index_sorted = generate_sort_index(sfc_clean_pd,'hh_age',sort_cache)
 
-# -- Call generate_densities to get pdf and cdf.
-net_worth_pdf, net_worth_cdf = generate_densities(weights_np,net_worth_index_sorted)
-income_total_pdf, income_total_cdf = generate_densities(weights_np,income_total_index_sorted)
+# -- Call generate_ecdf to get pdf and cdf.
+net_worth_pdf, net_worth_cdf, _ = generate_ecdf(weights_np,np.array(sfc_clean_pd['net_worth']),
+                                                net_worth_index_sorted)
+income_total_pdf, income_total_cdf, _ = generate_ecdf(weights_np,
+                                                      np.array(sfc_clean_pd['income_total']),
+                                                      income_total_index_sorted)
 
 
 #________ Compute income deciles/quantiles___________________________________#
@@ -83,14 +175,14 @@ deciles = [0.1,0.2,0.3,0.4,0.5,0.6,0.7,0.8,0.9]
 quintiles = [.2,0.4,0.6,0.8]
 
 
-# -- call generate_bins function. Needs cdf from previous step.
+# -- call generate_bins_batch function. Needs cdf from previous step.
 
-income_total_quintiles = generate_bins(quintiles,income_total_cdf)
-income_total_deciles  = generate_bins(deciles,income_total_cdf)
+income_total_quintiles, income_total_deciles = generate_bins_batch([quintiles,deciles],
+                                                                   income_total_cdf)
 
 # -- sort dataframe by income and add new series.
 
-sfc_clean_sort_income_total = sfc_clean_pd.sort_values(by=['income_total'])
+sfc_clean_sort_income_total = sfc_clean_pd.take(income_total_index_sorted)
 sfc_clean_sort_income_total['income_total_pdf'] = income_total_pdf
 sfc_clean_sort_income_total['income_total_cdf'] = income_total_cdf
 sfc_clean_sort_income_total['income_total_deciles'] = income_total_deciles
@@ -101,14 +193,14 @@ sfc_clean_sort_income_total['income_total_quintiles'] = income_total_quintiles
 
 #________ Compute wealth deciles/quantiles___________________________________#
 
-# -- call generate_bins function. Needs cdf from previous step.
+# -- call generate_bins_batch function. Needs cdf from previous step.
 
-net_worth_quintiles = generate_bins(quintiles,net_worth_cdf)
-net_worth_deciles   = generate_bins(deciles,net_worth_cdf)
+net_worth_quintiles, net_worth_deciles = generate_bins_batch([quintiles,deciles],
+                                                             net_worth_cdf)
 
 # -- sort dataframe by wealth and add new series.
 
-sfc_clean_sort_net_worth = sfc_clean_pd.sort_values(by=['net_worth'])
+sfc_clean_sort_net_worth = sfc_clean_pd.take(net_worth_index_sorted)
 sfc_clean_sort_net_worth['net_worth_pdf'] = net_worth_pdf
 sfc_clean_sort_net_worth['net_worth_cdf'] = net_worth_cdf
 sfc_clean_sort_net_worth['net_worth_deciles'] = net_worth_deciles
@@ -116,6 +208,30 @@ sfc_clean_sort_net_worth['net_worth_quintiles'] = net_worth_quintiles
 
 
 
+#________ Compute percentiles of income/wealth _______________________________#
+
+# -- levels P1...P99, P99.9 and P99.99, all read from the cdfs in one call per variable.
+
+percentile_levels = np.concatenate((np.arange(1,100)/100,[0.999,0.9999]))
+
+percentiles = pd.DataFrame(
+        generate_weighted_quantiles(np.column_stack([sfc_clean_sort_net_worth['net_worth'],
+                                                     sfc_clean_sort_income_total['income_total']]),
+                                    np.column_stack([net_worth_cdf,income_total_cdf]),
+                                    percentile_levels),
+        index=pd.Index(percentile_levels,name='level'),columns=['net_worth','income_total'])
+
+# -- in which percentile of the wealth distribution are some levels of net worth.
+
+net_worth_thresholds = [0,100000,1000000,10000000]
+
+percentile_ranks_net_worth = pd.DataFrame(
+        {'net_worth_rank':generate_percentile_ranks(sfc_clean_sort_net_worth['net_worth'],
+                                                    net_worth_cdf,net_worth_thresholds)},
+        index=pd.Index(net_worth_thresholds,name='net_worth'))
+
+
+
 #_________________________________ compute age groups _______________________#
 
 # -- bin end-points for age.
@@ -124,7 +240,7 @@ age_bin_end_points = [35,45,55,65]
 
 # -- extract age as sorted np array
 
-age_np = np.sort(np.array(sfc_clean_pd['hh_age']))
+age_np = np.array(sfc_clean_pd['hh_age'])[hh_age_index_sorted]
 
 # -- age
 
@@ -132,7 +248,7 @@ age_bin = generate_bins(age_bin_end_points,age_np)
 
 # -- sort dataframe by age and add new series.
 
-sfc_clean_sort_age = sfc_clean_pd.sort_values(by=['hh_age'])
+sfc_clean_sort_age = sfc_clean_pd.take(hh_age_index_sorted)
 sfc_clean_sort_age['age_bin'] = age_bin
 
 
@@ -144,18 +260,81 @@ sfc_clean_sort_age['age_bin'] = age_bin
 
 
 
-# -- Note that gini requires variable to be sorted.
+# -- grid of weighted population shares where all the Lorenz and concentration curves are
+#    evaluated, so that their size does not depend on the number of households.
+
+lorenz_grid = np.linspace(0,1,1001)
+
+# -- gini co and lorenz curves for net worth and income in one call, reusing the sort
+#    permutations from sort_cache.
+
+gini_np, lorenz_np, cumulative_shares = generate_gini_batch(
+        np.array(sfc_clean_pd[['net_worth','income_total']]),weights_np,
+        np.column_stack([net_worth_index_sorted,income_total_index_sorted]),lorenz_grid,
+        mycumulative=True)
+gini_net_worth, gini_income_total = gini_np
+lorenz_net_worth, lorenz_income_total = lorenz_np[:,0], lorenz_np[:,1]
+
+# -- top shares (top 10%, 1%, 0.1% and 0.01%) from the same cumulative shares. Levels finer
+#    than the sample supports are interpolated with a Pareto tail.
+
+top_levels = [0.1,0.01,0.001,0.0001]
 
-# -- gini co for net worth
+top_shares = pd.DataFrame(generate_top_shares(np.array(sfc_clean_pd[['net_worth','income_total']]),
+                                              weights_np,top_levels,
+                                              mycumulativeshares=cumulative_shares),
+                          index=pd.Index(top_levels,name='top'),columns=['net_worth','income_total'])
 
-gini_net_worth, lorenz_net_worth = generate_gini(np.array(sfc_clean_sort_net_worth['net_worth']),
-                                     np.array(sfc_clean_sort_net_worth['hh_weight']),
-                                     sample_nobs)
+# -- other inequality indices: Theil, mean log deviation, Atkinson, generalized entropy,
+#    coefficient of variation and percentile ratios, reusing the sort permutations.
 
-# -- gini co for income
-gini_income_total, lorenz_income_total = generate_gini(np.array(sfc_clean_sort_income_total['income_total']),
-                                     np.array(sfc_clean_sort_income_total['hh_weight']),
-                                     sample_nobs)
+inequality_indices = generate_inequality_indices(sfc_clean_pd,'hh_weight',
+                                                 ['net_worth','income_total'],
+                                                 mysortcache=sort_cache)
+
+# -- Gini and Lorenz curve of net worth within each age group and each employment status,
+#    all the groups at once.
+
+gini_net_worth_age, lorenz_net_worth_age = generate_group_gini(sfc_clean_sort_age,'net_worth',
+                                                               'hh_weight','age_bin',lorenz_grid)
+gini_net_worth_employment, lorenz_net_worth_employment = generate_group_gini(
+        sfc_clean_pd,'net_worth','hh_weight','hh_employment_status',lorenz_grid)
+
+# -- between/within decompositions of the Theil index and of the Gini coefficient by age
+#    group and by employment status.
+
+decomposition_partitions = {'age':(sfc_clean_sort_age,'age_bin'),
+                            'employment':(sfc_clean_pd,'hh_employment_status')}
+
+inequality_decompositions = {}
+for partition, (dataset_iterate, group_iterate) in decomposition_partitions.items():
+    for variable in ['net_worth','income_total']:
+        inequality_decompositions['decomposition_'+variable+'_'+partition] = (
+                generate_inequality_decomposition(dataset_iterate,variable,'hh_weight',
+                                                  group_iterate))
+
+# -- decomposition of the Gini coefficient of income by source. The sources are the additive
+#    components of income_total (income_capital is dividends plus capital gains).
+
+income_components = ['income_wage','income_bussiness','income_dividendsinterests',
+                     'income_capitalgains','income_retirementincome','income_transfers']
+
+source_decomposition = generate_source_decomposition(sfc_clean_pd,'income_total',income_components,
+                                                     'hh_weight',income_total_index_sorted)
+
+# -- concentration of wealth along the income distribution, and of debt and home equity
+#    along the wealth distribution, reusing the sort permutations of the ranking variables.
+
+concentration_net_worth_by_income, concentration_curve_net_worth_by_income = generate_concentration(
+        sfc_clean_pd['income_total'],sfc_clean_pd['net_worth'],weights_np,income_total_index_sorted,
+        lorenz_grid)
+
+concentration_np, concentration_curve_np = generate_concentration(
+        sfc_clean_pd['net_worth'],np.array(sfc_clean_pd[['debt_total','net_home_equity']]),
+        weights_np,net_worth_index_sorted,lorenz_grid)
+concentration_debt_by_net_worth, concentration_home_equity_by_net_worth = concentration_np
+concentration_curve_debt_by_net_worth = concentration_curve_np[:,0]
+concentration_curve_home_equity_by_net_worth = concentration_curve_np[:,1]
 
 
 
@@ -180,29 +359,46 @@ average_total = generate_averages(sfc_clean_sort_income_total,'hh_weight')
 
 
 
+# -- Each partition is a contiguous range of rows of a sorted frame. Build the cumulative
+#    weighted sums once per sort order, then each bin costs two lookups.
+
+income_total_prefix_index = generate_prefix_index(sfc_clean_sort_income_total,'hh_weight',
+                                                  'income_total_cdf')
+net_worth_prefix_index = generate_prefix_index(sfc_clean_sort_net_worth,'hh_weight',
+                                               'net_worth_cdf')
+age_prefix_index = generate_prefix_index(sfc_clean_sort_age,'hh_weight','hh_age')
+
+
 #________________ Income Partition ___________________________________________#
 
 
-average_income_partition_quintiles = generate_averages(sfc_clean_sort_income_total,'hh_weight',
-                                                       'income_total_quintiles')
-average_income_partition_deciles = generate_averages(sfc_clean_sort_income_total,'hh_weight',
-                                                       'income_total_deciles')
+average_income_partition_quintiles = generate_bin_averages(income_total_prefix_index,quintiles)
+average_income_partition_deciles = generate_bin_averages(income_total_prefix_index,deciles)
 
     
         
 #_____________ Net Worth Partition ___________________________________________#
         
         
-average_net_worth_partition_quintiles = generate_averages(sfc_clean_sort_net_worth,'hh_weight',
-                                                       'net_worth_quintiles')
-average_net_worth_partition_deciles = generate_averages(sfc_clean_sort_net_worth,'hh_weight',
-                                                       'net_worth_deciles')        
+average_net_worth_partition_quintiles = generate_bin_averages(net_worth_prefix_index,quintiles)
+average_net_worth_partition_deciles = generate_bin_averages(net_worth_prefix_index,deciles)
       
 
 #___________ Age Partition ___________________________________________________#
 
-average_age_partition = generate_averages(sfc_clean_sort_age,'hh_weight',
-                                                       'age_bin')
+average_age_partition = generate_bin_averages(age_prefix_index,age_bin_end_points)
+
+
+#___________ Joint Income and Net Worth Partition ____________________________#
+
+# -- population share and averages of every (income decile, net worth decile) cell. The
+#    deciles are put back in the original row order with generate_unsorted.
+
+joint_income_net_worth_shares, average_joint_income_net_worth = generate_joint_distribution(
+        sfc_clean_pd,'hh_weight',
+        generate_unsorted(income_total_index_sorted,income_total_deciles),
+        generate_unsorted(net_worth_index_sorted,net_worth_deciles),
+        len(deciles)+1,len(deciles)+1)
 
         
 #____________ Redefine some variables ________________________________________#
@@ -212,31 +408,176 @@ average_age_partition = generate_averages(sfc_clean_sort_age,'hh_weight',
 # redefine income sources as percentage of total income
 income_sources = ['income_wage','income_bussiness','income_capital','income_transfers','income_retirementincome']
 
-for variable_iterate in income_sources:
-    average_net_worth_partition_quintiles[variable_iterate] = average_net_worth_partition_quintiles[variable_iterate]/average_net_worth_partition_quintiles['income_total']*100; 
-    average_income_partition_quintiles[variable_iterate] = average_income_partition_quintiles[variable_iterate]/average_income_partition_quintiles['income_total']*100; 
-    average_age_partition[variable_iterate] = average_age_partition[variable_iterate]/average_age_partition['income_total']*100; 
-    average_net_worth_partition_deciles[variable_iterate] = average_net_worth_partition_deciles[variable_iterate]/average_net_worth_partition_deciles['income_total']*100; 
-    average_income_partition_deciles[variable_iterate] = average_income_partition_deciles[variable_iterate]/average_income_partition_deciles['income_total']*100; 
-    
 # redefine portfolio composition: financial assets/totalassets, home equity/net worth, secured debt/total debt
 portfolio_variables = ['assets_financial','debt_secured','net_home_equity']
 
-for variable_iterate in portfolio_variables:
-    average_net_worth_partition_quintiles[variable_iterate] = average_net_worth_partition_quintiles[variable_iterate]/average_net_worth_partition_quintiles['net_worth']*100; 
-    average_income_partition_quintiles[variable_iterate] = average_income_partition_quintiles[variable_iterate]/average_income_partition_quintiles['net_worth']*100; 
-    average_age_partition[variable_iterate] = average_age_partition[variable_iterate]/average_age_partition['net_worth']*100; 
-    average_net_worth_partition_deciles[variable_iterate] = average_net_worth_partition_deciles[variable_iterate]/average_net_worth_partition_deciles['net_worth']*100; 
-    average_income_partition_deciles[variable_iterate] = average_income_partition_deciles[variable_iterate]/average_income_partition_deciles['net_worth']*100; 
+ratio_definitions = {'income_total':income_sources,'net_worth':portfolio_variables}
+
+average_net_worth_partition_quintiles = generate_ratios(average_net_worth_partition_quintiles,ratio_definitions)
+average_income_partition_quintiles = generate_ratios(average_income_partition_quintiles,ratio_definitions)
+average_age_partition = generate_ratios(average_age_partition,ratio_definitions)
+average_net_worth_partition_deciles = generate_ratios(average_net_worth_partition_deciles,ratio_definitions)
+average_income_partition_deciles = generate_ratios(average_income_partition_deciles,ratio_definitions)
+
+
+
+
+###############################################################################
+################ Multiple implicates ##########################################
+###############################################################################
+
+# -- The survey stores five implicates per household. Compute the same partitions and
+#    Gini coefficients on each implicate, in parallel, and combine them with Rubin's rules.
+
+implicate_partitions = {'average_income_partition_quintiles':('income_total',quintiles,True),
+                        'average_income_partition_deciles':('income_total',deciles,True),
+                        'average_net_worth_partition_quintiles':('net_worth',quintiles,True),
+                        'average_net_worth_partition_deciles':('net_worth',deciles,True),
+                        'average_age_partition':('hh_age',age_bin_end_points,False)}
+
+implicate_datasets = [implicate_iterate for _, implicate_iterate in sfc_clean_pd.groupby(level='hh_implicate')]
+
+implicate_statistics = generate_parallel_map(partial(generate_partition_statistics,
+                                                     myweight='hh_weight',
+                                                     mypartitions=implicate_partitions,
+                                                     mygini=['net_worth','income_total']),
+                                             implicate_datasets,sfc_maxworkers)
+
+for statistics_iterate in implicate_statistics:
+    for name in implicate_partitions:
+        statistics_iterate[name] = generate_ratios(statistics_iterate[name],ratio_definitions)
+
+# -- Rubin's rules: point estimates (suffix _mi) and between-imputation variances (1+1/m)B
+#    (suffix _mi_between_variance). No within-imputation variances are passed: the sampling
+#    variance comes from the replicate weights in the next part.
+
+implicate_output = {}
+for name in implicate_statistics[0]:
+    implicate_output[name+'_mi'], implicate_output[name+'_mi_between_variance'] = generate_rubin(
+            [statistics_iterate[name] for statistics_iterate in implicate_statistics])
+
+
+
+
+###############################################################################
+################ Standard errors ##############################################
+###############################################################################
+
+# -- Sampling variances from the replicate weights. The averages of every partition under
+#    all the replicates come from one matrix product per group, with the partitions held
+#    fixed. The bins are put back in the original row order with generate_unsorted.
+
+replicate_partitions = {'average_total':(average_total,None),
+                        'average_income_partition_quintiles':(average_income_partition_quintiles,
+                            generate_unsorted(income_total_index_sorted,income_total_quintiles)),
+                        'average_income_partition_deciles':(average_income_partition_deciles,
+                            generate_unsorted(income_total_index_sorted,income_total_deciles)),
+                        'average_net_worth_partition_quintiles':(average_net_worth_partition_quintiles,
+                            generate_unsorted(net_worth_index_sorted,net_worth_quintiles)),
+                        'average_net_worth_partition_deciles':(average_net_worth_partition_deciles,
+                            generate_unsorted(net_worth_index_sorted,net_worth_deciles)),
+                        'average_age_partition':(average_age_partition,
+                            generate_unsorted(hh_age_index_sorted,age_bin))}
+
+# -- Standard errors use the total variance of Rubin's rules: the sampling variance from
+#    the replicates plus the between-imputation variance from the previous part.
+
+standard_errors = {}
+for name, (table_iterate, partition_iterate) in replicate_partitions.items():
+    replicate_averages = generate_replicate_averages(sfc_clean_pd,sfc_replicate_weights,
+                                                     partition_iterate)
+    if partition_iterate is not None:
+        replicate_averages = generate_ratios(replicate_averages,ratio_definitions)
+    replicate_variance = generate_replicate_variance(table_iterate[list(sfc_clean_pd)],
+                                                     replicate_averages)
+    standard_errors['se_'+name] = (replicate_variance
+                                   + implicate_output[name+'_mi_between_variance'])**0.5
+
+for name, gini_iterate, mysortindex in [('net_worth',gini_net_worth,net_worth_index_sorted),
+                                         ('income_total',gini_income_total,income_total_index_sorted)]:
+    replicate_gini = generate_gini_replicates(sfc_clean_pd[name],sfc_replicate_weights,mysortindex)
+    replicate_variance = generate_replicate_variance(gini_iterate,replicate_gini)
+    standard_errors['se_gini_'+name] = (replicate_variance
+                                        + implicate_output['gini_'+name+'_mi_between_variance'])**0.5
+
+
+###############################################################################
+################ Histograms ###################################################
+###############################################################################
+
+# -- Weighted histograms of net worth and income for the final step, which only needs the
+#    counts and the edges. Households with net worth or income at or above histogram_trim
+#    times the average are dropped to make the histograms nice. Kuhn and Rios-Rull (2016)
+#    do the same.
+
+histogram_trim = 5
+histogram_bins = {'net_worth':50,'income_total':80}
+
+histogram_keep = np.ones(sample_nobs,dtype=bool)
+for variable in histogram_bins:
+    histogram_keep &= np.array(sfc_clean_pd[variable]) < histogram_trim*average_total[variable].iloc[0]
+
+histograms = {}
+for variable, bins_iterate in histogram_bins.items():
+    histograms['histogram_counts_'+variable], histograms['histogram_edges_'+variable] = (
+            generate_histogram(sfc_clean_pd[variable],weights_np,bins_iterate,histogram_keep))
+
+
+###############################################################################
+################ Kernel densities #############################################
+###############################################################################
+
+# -- Weighted kernel densities of net worth and income, trimmed as the histograms, and of
+#    their inverse hyperbolic sine, for the whole sample and by age group. The age groups
+#    are put back in the original row order with generate_unsorted.
+
+kde_gridsize = 1024
+
+kde_dataset = sfc_clean_pd[['net_worth','income_total','hh_weight']].assign(
+        net_worth_asinh=np.arcsinh(sfc_clean_pd['net_worth']),
+        income_total_asinh=np.arcsinh(sfc_clean_pd['income_total']),
+        age_bin=generate_unsorted(hh_age_index_sorted,age_bin))
+
+kde_definitions = {'net_worth':histogram_keep,'income_total':histogram_keep,
+                   'net_worth_asinh':None,'income_total_asinh':None}
+
+densities = {}
+for variable, keep_iterate in kde_definitions.items():
+    densities['kde_'+variable] = generate_kde(kde_dataset,variable,'hh_weight',kde_gridsize,
+                                              mygroup='age_bin',mykeep=keep_iterate)
+
+
+###############################################################################
+################ Bootstrap confidence intervals ###############################
+###############################################################################
+
+# -- number of draws and seed. The draws are seeded one by one, so the intervals do not
+#    depend on the number of processes. The Lorenz bands use the grid of the Lorenz curves.
+#    The five implicates of a household are one cluster, so they get the same draw.
+
+bootstrap_draws = 1000
+bootstrap_seed = 2016
 
+gini_ci_np, lorenz_ci_np = generate_gini_bootstrap(np.array(sfc_clean_pd[['net_worth','income_total']]),
+                                                   weights_np,bootstrap_draws,bootstrap_seed,
+                                                   lorenz_grid,
+                                                   np.column_stack([net_worth_index_sorted,
+                                                                    income_total_index_sorted]),
+                                                   mycodes=sfc_clean_pd.index.get_level_values('hh_id'),
+                                                   mymaxworkers=sfc_maxworkers)
 
+bootstrap_intervals = {'gini_net_worth_ci':gini_ci_np[:,0],
+                       'gini_income_total_ci':gini_ci_np[:,1],
+                       'lorenz_net_worth_ci':lorenz_ci_np[:,:,0],
+                       'lorenz_income_total_ci':lorenz_ci_np[:,:,1]}
 
 
 ###############################################################################
 ############ Store Everything to produce final output #########################
 ###############################################################################
     
-# -- merge into a dictionary
+# -- merge into a dictionary. The microdata is stored once: the frames sorted by net worth
+#    and income are stored as views, i.e. the sort permutation plus the new columns.
     
 data_to_output = {'average_net_worth_partition_quintiles':average_net_worth_partition_quintiles,
               'average_income_partition_quintiles': average_income_partition_quintiles,
@@ -244,17 +585,48 @@ data_to_output = {'average_net_worth_partition_quintiles':average_net_worth_part
               'average_net_worth_partition_deciles':average_net_worth_partition_deciles,
               'average_income_partition_deciles':average_income_partition_deciles,
               'average_total':average_total,
+              'joint_income_net_worth_shares':joint_income_net_worth_shares,
+              'average_joint_income_net_worth':average_joint_income_net_worth,
               'gini_net_worth': gini_net_worth,
               'gini_income_total':gini_income_total,
+              'top_shares':top_shares,
+              'inequality_indices':inequality_indices,
+              'source_decomposition':source_decomposition,
+              'concentration_net_worth_by_income':concentration_net_worth_by_income,
+              'concentration_debt_by_net_worth':concentration_debt_by_net_worth,
+              'concentration_home_equity_by_net_worth':concentration_home_equity_by_net_worth,
+              'concentration_curve_net_worth_by_income':concentration_curve_net_worth_by_income,
+              'concentration_curve_debt_by_net_worth':concentration_curve_debt_by_net_worth,
+              'concentration_curve_home_equity_by_net_worth':concentration_curve_home_equity_by_net_worth,
+              'gini_net_worth_age':gini_net_worth_age,
+              'lorenz_net_worth_age':lorenz_net_worth_age,
+              'gini_net_worth_employment':gini_net_worth_employment,
+              'lorenz_net_worth_employment':lorenz_net_worth_employment,
               'lorenz_net_worth':lorenz_net_worth,
               'lorenz_income_total': lorenz_income_total,
+              'lorenz_grid':lorenz_grid,
+              'percentiles':percentiles,
+              'percentile_ranks_net_worth':percentile_ranks_net_worth,
               'sfc_clean_pd':sfc_clean_pd,
-              'sfc_clean_sort_net_worth':sfc_clean_sort_net_worth,
-              'sfc_clean_sort_income_total':sfc_clean_sort_income_total
+              'sfc_clean_sort_net_worth':generate_sorted_view('sfc_clean_pd',net_worth_index_sorted,
+                  {'net_worth_pdf':net_worth_pdf,
+                   'net_worth_cdf':net_worth_cdf,
+                   'net_worth_deciles':net_worth_deciles,
+                   'net_worth_quintiles':net_worth_quintiles}),
+              'sfc_clean_sort_income_total':generate_sorted_view('sfc_clean_pd',income_total_index_sorted,
+                  {'income_total_pdf':income_total_pdf,
+                   'income_total_cdf':income_total_cdf,
+                   'income_total_deciles':income_total_deciles,
+                   'income_total_quintiles':income_total_quintiles})
         }
+data_to_output.update(inequality_decompositions)
+data_to_output.update(implicate_output)
+data_to_output.update(standard_errors)
+data_to_output.update(bootstrap_intervals)
+data_to_output.update(histograms)
+data_to_output.update(densities)
 
 
-# -- save dictionary
+# -- save dictionary as an artifact
 
-with open(ppj("OUT_ANALYSIS", "data_to_output.pkl"), "wb") as out_file:
-    pkl.dump(data_to_output, out_file)
+write_artifact(ppj("OUT_ANALYSIS",*sfc_outdir,"data_to_output.artifact"), data_to_output)
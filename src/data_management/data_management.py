@@ -3,11 +3,18 @@ This module called *data_management* prepares the inputs for the
 *analysis step*.  
 
 First, it loads the raw data from the
-folder *original_data*. 
+folder *original_data*. By default it processes the 2016 wave of the
+survey. In the multi-wave build the year of the wave is passed as the
+first command line argument, the raw files of that wave are read and
+the outputs are saved to the subfolder *waves/<year>* of *OUT_DATA*.
+Only the columns listed in *sfc_columns* are read: they are converted
+once to a columnar cache in *OUT_DATA* (see the module *mystorage*) and
+later runs memory-map them.
 
 Second, since the original dataset it large, the 
 goal is to keep the variables of interest so that we don't have
-to carry out the whole analysis with a heavy dataframe.
+to carry out the whole analysis with a heavy dataframe. The
+variables below are built chunk by chunk by *generate_sfc_clean*.
 
 Third, it renames the variables that we are going to use to 
 more user-friendly names, such that we can access them more
@@ -19,88 +26,163 @@ for the final results. These are:
    * income_capital: a measure of total capital income.
    * net_home_equity: total housing assets minus total secured debt.
    * debt_non_secured: total debt minus secured debt.
+   * hh_implicate: number (1 to 5) of the imputation replicate. The survey
+     stores five implicates per household, all with the same *hh_id*, so
+     the index of *sfc_clean_pd* is the pair (*hh_id*, *hh_implicate*).
+
+Fifth, it loads the replicate weights of the survey (file *p16_rw1.dta*
+for 2016), which has one row per household,
+and arranges them as a matrix *sfc_replicate_weights* with one row per
+observation of *sfc_clean_pd* and one column per replicate: the five
+implicates of a household share its replicate weights.
 
 Finally it saves all these elements together into
-a dataframe called *sfc_clean_pd* and saves it to the folder
+a dataframe called *sfc_clean_pd* and saves it, with the replicate
+weights, as an artifact (see the module *mystorage*) to the folder
 *OUT_DATA*. This object will be the input for the analysis step.
 
 
 """
+import sys
 import numpy as np
 import pandas as pd
-import pickle as pkl
 from bld.project_paths import project_paths_join as ppj
+from src.functions.mystorage import read_stata_cached, read_stata_varlist, iterate_chunks
+from src.functions.mystorage import write_artifact
+from src.functions.myfunctions import generate_replicate_weights
+
+
+# -- Columns of the raw survey that are used below.
+
+sfc_columns = ['wageinc','bussefarminc','intdivinc','kginc','ssretinc','transfothinc',
+               'networth','asset','fin','nfin','houses','oresre','debt','mrthel','resdbt',
+               'age','OCCAT1','YY1','Y1','wgt']
+
+# -- Survey wave. Without arguments the 2016 wave is processed and the outputs keep their
+#    usual names. The multi-wave build passes the year and gets one folder per wave, so that
+#    the waves can run as parallel jobs.
+
+sfc_wave = sys.argv[1] if len(sys.argv) > 1 else None
+sfc_year = sfc_wave or '2016'
+sfc_outdir = ('waves',sfc_wave) if sfc_wave else ()
+
+# -- Load data. Only the columns above are read, through the columnar cache.
+
+sfc_chunksize = 100000
+sfc16_columns = read_stata_cached(ppj("IN_DATA",f"sfc{sfc_year}.dta"),sfc_columns,
+                                  ppj("OUT_DATA",*sfc_outdir,f"sfc{sfc_year}_cache"),sfc_chunksize)
+
+
+def generate_sfc_clean(sfc16):
+    """ Renames the variables of interest and generates the additional variables.
+
+     Args:
+         * sfc16: dictionary of arrays containing (a chunk of) the columns in *sfc_columns*.
+
+     Returns:
+         * sfc_clean_chunk: Data Frame containing the variables of *sfc_clean_pd*.
+
+     """
+
+    # -- Income variables.
+
+    income_wage = sfc16['wageinc']
+    income_bussiness = sfc16['bussefarminc']
+    income_dividendsinterests = sfc16['intdivinc']
+    income_capitalgains = sfc16['kginc']
+    income_retirementincome = sfc16['ssretinc']
+    income_transfers = sfc16['transfothinc']
+    income_capital = income_capitalgains + income_dividendsinterests
+    income_total = income_bussiness + income_capitalgains + income_dividendsinterests + income_retirementincome + income_transfers + income_wage 
+
+
+    # -- Wealth variables.
+
+    net_worth = sfc16['networth']
+    assets_total = sfc16['asset']
+    assets_financial = sfc16['fin']
+    assets_nfin = sfc16['nfin']
+    assets_house_main = sfc16['houses']
+    assets_house_other = sfc16['oresre']
+    debt_total = sfc16['debt']
+    debt_secured = sfc16['mrthel'] + sfc16['resdbt']
+    debt_nonsecured = debt_total - debt_secured
+    net_home_equity = assets_house_main + assets_house_other - debt_secured
+
+    # -- Household characteristics.
+
+    hh_age = sfc16['age']
+    hh_employment_status = sfc16['OCCAT1']
+    hh_id = sfc16['YY1']
+    hh_implicate = sfc16['Y1'] - 10*sfc16['YY1']
+    hh_weight = sfc16['wgt']
+
+    # -- Bundle everything into a data frame.
+
+    sfc_clean_chunk = pd.DataFrame({'income_wage':income_wage,
+                                    'income_bussiness':income_bussiness,
+                                    'income_dividendsinterests':income_dividendsinterests,
+                                    'income_capitalgains':income_capitalgains,
+                                    'income_retirementincome':income_retirementincome,
+                                    'income_transfers':income_transfers,
+                                    'income_capital':income_capital,
+                                    'income_total':income_total,
+                                    'net_worth':net_worth,
+                                    'assets_total':assets_total,
+                                    'assets_financial':assets_financial,
+                                    'assets_nfin':assets_nfin,
+                                    'assets_house_main':assets_house_main,
+                                    'assets_house_other':assets_house_other,
+                                    'debt_total':debt_total,
+                                    'debt_secured':debt_secured,
+                                    'debt_nonsecured':debt_nonsecured,
+                                    'net_home_equity':net_home_equity,
+                                    'hh_age':hh_age,
+                                    'hh_employment_status':hh_employment_status,
+                                    'hh_id':hh_id,
+                                    'hh_implicate':hh_implicate,
+                                    'hh_weight':hh_weight})
+
+    return sfc_clean_chunk
+
 
+# -- Build the derived variables chunk by chunk, so that peak memory scales with the
+#    projected columns and not with the whole extract.
 
-# -- Load data.
-
-sfc16 = pd.read_stata(ppj("IN_DATA","sfc2016.dta"))
-
-# -- Income variables.
-
-income_wage = sfc16['wageinc']
-income_bussiness = sfc16['bussefarminc']
-income_dividendsinterests = sfc16['intdivinc']
-income_capitalgains = sfc16['kginc']
-income_retirementincome = sfc16['ssretinc']
-income_transfers = sfc16['transfothinc']
-income_capital = income_capitalgains + income_dividendsinterests
-income_total = income_bussiness + income_capitalgains + income_dividendsinterests + income_retirementincome + income_transfers + income_wage 
-
-
-# -- Wealth variables.
-
-net_worth = sfc16['networth']
-assets_total = sfc16['asset']
-assets_financial = sfc16['fin']
-assets_nfin = sfc16['nfin']
-assets_house_main = sfc16['houses']
-assets_house_other = sfc16['oresre']
-debt_total = sfc16['debt']
-debt_secured = sfc16['mrthel'] + sfc16['resdbt']
-debt_nonsecured = debt_total - debt_secured
-net_home_equity = assets_house_main + assets_house_other - debt_secured
-
-# -- Household characteristics.
-
-hh_age = sfc16['age']
-hh_employment_status = sfc16['OCCAT1']
-hh_id = sfc16['YY1']
-hh_weight = sfc16['wgt']
-
-# -- Bundle everything into a dictionary.
-
-sfc_clean_dict = {'income_wage':income_wage,
-                           'income_bussiness':income_bussiness,
-                           'income_dividendsinterests':income_dividendsinterests,
-                           'income_capitalgains':income_capitalgains,
-                           'income_retirementincome':income_retirementincome,
-                           'income_transfers':income_transfers,
-                           'income_capital':income_capital,
-                           'income_total':income_total,
-                           'net_worth':net_worth,
-                           'assets_total':assets_total,
-                           'assets_financial':assets_financial,
-                           'assets_nfin':assets_nfin,
-                           'assets_house_main':assets_house_main,
-                           'assets_house_other':assets_house_other,
-                           'debt_total':debt_total,
-                           'debt_secured':debt_secured,
-                           'debt_nonsecured':debt_nonsecured,
-                           'net_home_equity':net_home_equity,
-                           'hh_age':hh_age,
-                           'hh_employment_status':hh_employment_status,
-                           'hh_id':hh_id,
-                           'hh_weight':hh_weight}
-
-# -- Convert to data frame and set index.
-
-sfc_clean_pd = pd.DataFrame(sfc_clean_dict)
-sfc_clean_pd.set_index('hh_id',inplace=True)
-
-
-# -- Save to pickle.
-
-with open(ppj("OUT_DATA", "sfc_clean_pd.pkl"), "wb") as out_file:
-    pkl.dump(sfc_clean_pd, out_file)
+sfc_clean_pd = pd.concat([generate_sfc_clean(sfc16)
+                          for sfc16 in iterate_chunks(sfc16_columns,sfc_chunksize)],
+                         ignore_index=True)
+
+# -- Set index. A household appears once per implicate, so (hh_id, hh_implicate) identifies
+#    each row. Keeping hh_implicate in the index also keeps it out of the averages.
+
+sfc_clean_pd.set_index(['hh_id','hh_implicate'],inplace=True)
+
+
+# -- Replicate weights. The survey ships 999 replicate weights in a separate file, as
+#    weights wt1b1...wt1b999 and multiplicity factors mm1...mm999, one row per household
+#    (YY1). The replicate weight is their product. Store them as a matrix with one column
+#    per replicate and the weights of each household on all its implicates, in the same
+#    row order as sfc_clean_pd. The ~2,000 columns are read into memory rather than
+#    memory-mapped, which would keep one file descriptor open per column.
+
+rw_path = ppj("IN_DATA",f"p{sfc_year[2:]}_rw1.dta")
+rw_varlist = {variable.lower():variable for variable in read_stata_varlist(rw_path)}
+rw_nreplicates = sum(variable.startswith('wt1b') for variable in rw_varlist)
+rw_weights = [rw_varlist[f'wt1b{r}'] for r in range(1,rw_nreplicates+1)]
+rw_multiplicities = [rw_varlist[f'mm{r}'] for r in range(1,rw_nreplicates+1)]
+rw_columns = read_stata_cached(rw_path,[rw_varlist['yy1']] + rw_weights + rw_multiplicities,
+                               ppj("OUT_DATA",*sfc_outdir,f"p{sfc_year[2:]}_rw1_cache"),
+                               sfc_chunksize,mymemmap=False)
+
+sfc_replicate_weights = generate_replicate_weights(
+        sfc16_columns['YY1'],rw_columns[rw_varlist['yy1']],
+        np.column_stack([rw_columns[column] for column in rw_weights]),
+        np.column_stack([rw_columns[column] for column in rw_multiplicities]))
+
+
+# -- Save to artifact.
+
+write_artifact(ppj("OUT_DATA",*sfc_outdir,"sfc_clean_pd.artifact"),
+               {'sfc_clean_pd':sfc_clean_pd,'sfc_replicate_weights':sfc_replicate_weights})
 
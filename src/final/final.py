@@ -1,7 +1,8 @@
 """
 This module called *final* does the *final step*.
 
-First, it loads the data generated in the *analysis step* and unpacks it appropiately. 
+First, it loads the data generated in the *analysis step* and unpacks it appropiately. Only
+the entries of the artifact that are used below are read.
 
 The main goal of this module is to produces tables in latex format and
 plots such that they can be included into the .tex file right the way.
@@ -20,13 +21,18 @@ The module can be broadly subdivided into two different parts.
 		* Quintiles of Income Distribution.
 		* Age Distribution.
 		* Gini Coefficients.
+		* Decomposition of the Theil index and the Gini Coefficient by age and employment status.
 
 	* Prepare Histograms and Lorenz: it generates two histograms and two Lorenz curves 
-	  that are reported in the paper:
+	  that are reported in the paper. The histograms are drawn from the weighted counts
+	  computed in the *analysis step*, so the microdata is not loaded:
 		* Histogram of Income.
 		* Histogram of Net Worth.
-		* Lorenz curve of Income.
-		* Lorenz curve of Net Worth.
+		* Lorenz curve of Income, with its bootstrap confidence band.
+		* Lorenz curve of Net Worth, with its bootstrap confidence band.
+		* Heatmap of the joint distribution of income and net worth deciles.
+		* Kernel densities of the inverse hyperbolic sine of income and of net worth, for
+		  all households and by age group.
 
 Figures and tables are stored in the folders *OUT_FIGURES* and *OUT_TABLES*, respectively.
 
@@ -35,13 +41,27 @@ Figures and tables are stored in the folders *OUT_FIGURES* and *OUT_TABLES*, res
 
 
 from bld.project_paths import project_paths_join as ppj
-import numpy as np
 import pandas as pd
-import pickle as pkl
 import matplotlib.pyplot as plt
+from src.functions.mystorage import read_artifact
 
 # -- Read data.
-data_to_output = pkl.load(open(ppj("OUT_ANALYSIS","data_to_output.pkl"),"rb"))
+data_to_output = read_artifact(ppj("OUT_ANALYSIS","data_to_output.artifact"),
+                               ['average_net_worth_partition_quintiles',
+                                'average_net_worth_partition_deciles',
+                                'average_income_partition_quintiles',
+                                'average_income_partition_deciles',
+                                'average_age_partition',
+                                'histogram_counts_net_worth','histogram_edges_net_worth',
+                                'histogram_counts_income_total','histogram_edges_income_total',
+                                'lorenz_net_worth','lorenz_income_total','lorenz_grid',
+                                'lorenz_net_worth_ci','lorenz_income_total_ci',
+                                'gini_net_worth','gini_income_total',
+                                'decomposition_net_worth_age','decomposition_income_total_age',
+                                'decomposition_net_worth_employment',
+                                'decomposition_income_total_employment',
+                                'joint_income_net_worth_shares',
+                                'kde_net_worth_asinh','kde_income_total_asinh'])
 
 
 # -- Read out dictionary
@@ -54,14 +74,16 @@ income_deciles = data_to_output['average_income_partition_deciles']
 
 age_partition = data_to_output['average_age_partition']
 
-average_total = data_to_output['average_total']
-
-sfc_clean_pd = data_to_output['sfc_clean_pd']
-sfc_net_worth_sort = data_to_output['sfc_clean_sort_net_worth']
-sfc_income_sort = data_to_output['sfc_clean_sort_income_total']
+histogram_counts_net_worth = data_to_output['histogram_counts_net_worth']
+histogram_edges_net_worth = data_to_output['histogram_edges_net_worth']
+histogram_counts_income = data_to_output['histogram_counts_income_total']
+histogram_edges_income = data_to_output['histogram_edges_income_total']
 
 lorenz_net_worth = data_to_output['lorenz_net_worth']
 lorenz_income = data_to_output['lorenz_income_total']
+lorenz_grid = data_to_output['lorenz_grid']
+lorenz_net_worth_ci = data_to_output['lorenz_net_worth_ci']
+lorenz_income_ci = data_to_output['lorenz_income_total_ci']
 
 gini_networth = data_to_output['gini_net_worth']
 gini_income   = data_to_output['gini_income_total']
@@ -143,6 +165,16 @@ age_partition_table.columns = rename_age
 
 gini_pd = pd.DataFrame(data=([gini_income,gini_networth]))
 
+# -- Decomposition of inequality by age and employment status, one block per partition and variable.
+
+decomposition_table = pd.concat(
+        {(partition_name,variable_name):data_to_output['decomposition_'+variable+'_'+partition]
+         for partition, partition_name in [('age','Age'),('employment','Employment Status')]
+         for variable, variable_name in [('income_total','Income'),('net_worth','Net Worth')]},
+        names=['Partition','Variable','Index'])
+decomposition_table = decomposition_table.rename(index={'theil':'Theil','gini':'Gini'})
+decomposition_table.columns = ['Total','Within','Between','Overlap']
+
 
 
 # --- Save to latex
@@ -164,32 +196,36 @@ with open(ppj("OUT_TABLES", "age_partition.tex"), "w") as tf:
 
 with open(ppj("OUT_TABLES", "ginis.tex"), "w") as tf:
      tf.write(gini_pd.to_latex())
+
+with open(ppj("OUT_TABLES", "decomposition_table.tex"), "w") as tf:
+     tf.write(decomposition_table.to_latex(float_format='%.3f',na_rep='-'))
      
 ###############################################################################
 ############### Prepare Histogram and Lorez  ##################################
 ###############################################################################
 
-# -- drop super wealthy guys to make the histogram nice. Kuhn and Rios-Rull (2016) do the same. 
-
-sfc_clean_pd.drop(sfc_clean_pd[sfc_clean_pd.net_worth >= 5*float(average_total['net_worth'])].index,inplace=True)
-sfc_clean_pd.drop(sfc_clean_pd[sfc_clean_pd.income_total >= 5*float(average_total['income_total'])].index,inplace=True)
+# -- the weighted counts come from the analysis step, where the super wealthy guys are
+#    dropped to make the histogram nice.
 
 plt.figure()
-plt.hist(sfc_clean_pd['net_worth']/1000,bins=50)
+plt.hist(histogram_edges_net_worth[:-1]/1000,bins=histogram_edges_net_worth/1000,
+         weights=histogram_counts_net_worth)
 plt.xlabel('Net Worth (Thousands) ')
-plt.ylabel('Frequency')
+plt.ylabel('Households')
 plt.title('Histogram of Net Worth')
 plt.savefig(ppj("OUT_FIGURES","histogram_networth.png"))
 
 plt.figure()
-plt.hist(sfc_clean_pd['income_total']/1000,bins=80)
+plt.hist(histogram_edges_income[:-1]/1000,bins=histogram_edges_income/1000,
+         weights=histogram_counts_income)
 plt.xlabel('Income (Thousands) ')
-plt.ylabel('Frequency')
+plt.ylabel('Households')
 plt.title('Histogram of Income')
 plt.savefig(ppj("OUT_FIGURES","histogram_income.png"))
 
 plt.figure()
-plt.plot(np.linspace(0.0, 1.0, lorenz_income.size), lorenz_income,'b')
+plt.fill_between(lorenz_grid, lorenz_income_ci[0], lorenz_income_ci[1], color='b', alpha=0.2)
+plt.plot(lorenz_grid, lorenz_income,'b')
 plt.plot([0,1], [0,1],'k')
 plt.xlabel('% of Population')
 plt.ylabel('% of Income Owned')
@@ -197,9 +233,35 @@ plt.title('Lorenz Curve of Income')
 plt.savefig(ppj("OUT_FIGURES","lorenz_income.png"))
 
 plt.figure()
-plt.plot(np.linspace(0.0, 1.0, lorenz_net_worth.size), lorenz_net_worth,'b')
+plt.fill_between(lorenz_grid, lorenz_net_worth_ci[0], lorenz_net_worth_ci[1], color='b', alpha=0.2)
+plt.plot(lorenz_grid, lorenz_net_worth,'b')
 plt.plot([0,1], [0,1],'k')
 plt.xlabel('% of Population')
 plt.ylabel('% of Net Worth Owned')
 plt.title('Lorenz Curve of Net Worth')
-plt.savefig(ppj("OUT_FIGURES","lorenz_networth.png"))
\ No newline at end of file
+plt.savefig(ppj("OUT_FIGURES","lorenz_networth.png"))
+
+plt.figure()
+plt.imshow(100*data_to_output['joint_income_net_worth_shares'],origin='lower',cmap='viridis')
+plt.colorbar(label='% of Population')
+plt.xticks(range(10),rename_deciles)
+plt.yticks(range(10),rename_deciles)
+plt.xlabel('Net Worth Decile')
+plt.ylabel('Income Decile')
+plt.title('Joint Distribution of Income and Net Worth')
+plt.savefig(ppj("OUT_FIGURES","joint_income_networth.png"))
+
+# -- kernel densities: all households in black, the age groups in colors.
+
+for variable, variable_name, figure_name in [('income_total_asinh','Income','kde_income_asinh.png'),
+                                             ('net_worth_asinh','Net Worth','kde_networth_asinh.png')]:
+    densities = data_to_output['kde_'+variable]
+    plt.figure()
+    plt.plot(densities.index,densities['density'],'k',label='All')
+    for column, age_name in zip(list(densities)[1:],rename_age):
+        plt.plot(densities.index,densities[column],label=age_name)
+    plt.xlabel('asinh('+variable_name+')')
+    plt.ylabel('Density')
+    plt.title('Density of '+variable_name)
+    plt.legend()
+    plt.savefig(ppj("OUT_FIGURES",figure_name))
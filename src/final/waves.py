@@ -0,0 +1,90 @@
+"""
+This module called *waves* stacks the results of the multi-wave build.
+
+The *data_management* and *analysis* steps run once per wave of the survey, as independent
+jobs, and save their results to the subfolders *waves/<year>*. The years of the waves are
+passed as command line arguments. This module reads the results of every wave and stacks
+them along a wave dimension:
+
+	* waves_trend: one row per wave with the Gini coefficients, their standard errors and
+	  bootstrap intervals, and the total averages of income and net worth.
+	* the tables of averages by partition, one per table, with the wave in the column *wave*.
+
+The stacked results are saved as an artifact (see the module *mystorage*) to the folder
+*OUT_FINAL*, and the trend table is exported to latex to the folder *OUT_TABLES*.
+
+
+"""
+
+import sys
+from bld.project_paths import project_paths_join as ppj
+import pandas as pd
+from src.functions.mystorage import read_artifact, write_artifact
+
+# -- Waves to stack.
+
+sfc_waves = sys.argv[1:]
+
+# -- Entries of each wave that are stacked.
+
+gini_names = ['gini_net_worth','gini_income_total']
+
+partition_names = ['average_net_worth_partition_quintiles',
+                   'average_net_worth_partition_deciles',
+                   'average_income_partition_quintiles',
+                   'average_income_partition_deciles',
+                   'average_age_partition']
+
+# -- Read data.
+
+wave_results = {wave:read_artifact(ppj("OUT_ANALYSIS","waves",wave,"data_to_output.artifact"),
+                                   gini_names + ['se_'+name for name in gini_names]
+                                   + [name+'_ci' for name in gini_names]
+                                   + ['average_total','se_average_total'] + partition_names)
+                for wave in sfc_waves}
+
+###############################################################################
+############### Stack the waves ###############################################
+###############################################################################
+
+# -- Trend table: one row per wave.
+
+trend_rows = []
+for wave, results_iterate in wave_results.items():
+    row = {'wave':int(wave)}
+    for name in gini_names:
+        row[name] = results_iterate[name]
+        row['se_'+name] = results_iterate['se_'+name]
+        row[name+'_lower'], row[name+'_upper'] = results_iterate[name+'_ci']
+    for name in ['net_worth','income_total']:
+        row['average_'+name] = results_iterate['average_total'][name].iloc[0]
+        row['se_average_'+name] = results_iterate['se_average_total'][name].iloc[0]
+    trend_rows.append(row)
+
+waves_trend = pd.DataFrame(trend_rows).set_index('wave')
+
+# -- Tables by partition: the rows of every wave one after the other.
+
+waves_output = {'waves_trend':waves_trend}
+for name in partition_names:
+    waves_output[name+'_waves'] = pd.concat([results_iterate[name].assign(wave=int(wave))
+                                             for wave, results_iterate in wave_results.items()])
+
+
+###############################################################################
+############### Save ##########################################################
+###############################################################################
+
+write_artifact(ppj("OUT_FINAL","waves.artifact"), waves_output)
+
+# -- Trend table in latex: Gini coefficients and averages in thousands of $.
+
+waves_trend_table = waves_trend[['gini_income_total','se_gini_income_total',
+                                 'gini_net_worth','se_gini_net_worth']].round(3)
+waves_trend_table['Income (Thousands of $)'] = (waves_trend['average_income_total']/1000).astype(int)
+waves_trend_table['Net Worth (Thousands of $)'] = (waves_trend['average_net_worth']/1000).astype(int)
+waves_trend_table.columns = ['Gini Income','S.E.','Gini Net Worth','S.E.',
+                             'Income (Thousands of $)','Net Worth (Thousands of $)']
+
+with open(ppj("OUT_TABLES", "waves_trend_table.tex"), "w") as tf:
+     tf.write(waves_trend_table.to_latex())
@@ -4,9 +4,116 @@ The module *myfunctions* contains the functions used during the *analysis step*.
 """
 
 
+import hashlib
+import multiprocessing
+from concurrent.futures import ProcessPoolExecutor
+
 import numpy as np
 import pandas as pd
 
+def generate_sort_index(mydataset,mycolumn,mysortcache):
+    """ Returns the stable permutation that sorts a column, computing it only once.
+
+     The permutation is kept in *mysortcache* together with a fingerprint of the column,
+     so that every kernel that needs the column sorted (densities, bins, Gini, sorted
+     frames) reuses it. If the values of the column change, the fingerprint no longer
+     matches and the permutation is computed again.
+
+     Args:
+         * mydataset: Data Frame containing the dataset.
+         * mycolumn: string indicating the name of the column to sort.
+         * mysortcache: dictionary used as cache, one per dataset.
+
+     Returns:
+         * mysortindex: array containing the permutation that sorts the column.
+
+     """
+
+    values = np.ascontiguousarray(mydataset[mycolumn].to_numpy())
+    fingerprint = (values.dtype.str,len(values),
+                   hashlib.blake2b(values.view(np.uint8),digest_size=16).hexdigest())
+    cached = mysortcache.get(mycolumn)
+    if cached is None or cached[0] != fingerprint:
+        cached = (fingerprint,np.argsort(values,kind='stable'))
+        mysortcache[mycolumn] = cached
+    mysortindex = cached[1]
+    return mysortindex
+
+
+def generate_unsorted(mysortindex,myvalues):
+    """ Puts values computed in sorted order back in the original order.
+
+     Args:
+         * mysortindex: array containing the permutation that sorts the data.
+         * myvalues: array containing values in the sorted order.
+
+     Returns:
+         * myunsorted: array containing the values in the original order.
+
+     """
+
+    myunsorted = np.empty_like(myvalues)
+    myunsorted[mysortindex] = myvalues
+    return myunsorted
+
+
+def generate_tie_groups(mysorted):
+    """ Finds the groups of tied values of a sorted variable.
+
+     Since the values are sorted, a new group starts wherever a value differs from the
+     previous one, so no second sort is needed.
+
+     Args:
+         * mysorted: array of shape (n,) containing the sorted values.
+
+     Returns:
+         * mycodes: array of shape (n,) containing the group of each value, numbered from 0
+           in increasing order of the values.
+
+     """
+
+    sx = np.asarray(mysorted)
+    mycodes = np.concatenate(([0],np.cumsum(sx[1:] != sx[:-1])))
+    return mycodes
+
+
+def generate_bins_batch(endpoints_list,myvariable):
+    """ Generates several partitions of a sample in a single vectorized pass.
+
+     The end points of all the partitions are located at once with a binary search
+     over the sorted variable, so the cost is O(n + k log n) instead of one scan of the
+     sample per end point. Observations up to (and including) the first end point
+     belong to bin 1, and observations above the last end point belong to bin k+1.
+
+     Args:
+         * endpoints_list: list of arrays, each containing the increasing end points of
+           one partition (e.g. quintiles, deciles, percentiles).
+         * myvariable: array containing the sorted variable according the which the
+           sample wants to be divided.
+
+     Returns:
+         * store_bins: array of shape (number of partitions, number of observations)
+           containing to which bin belongs each observation in each partition. The
+           integer dtype is the smallest one that holds all the bin codes.
+
+     """
+
+    myvariable = np.asarray(myvariable)
+    nobs = len(myvariable)
+    nendpoints = [len(endpoints) for endpoints in endpoints_list]
+    store_bins = np.empty(shape=(len(endpoints_list),nobs),
+                          dtype=np.min_scalar_type(max(nendpoints)+1))
+    # find who is the first HH above each end-point, for all partitions at once
+    endpoints_all = np.concatenate([np.ravel(endpoints) for endpoints in endpoints_list])
+    store_position = np.searchsorted(myvariable,endpoints_all,side='right')
+    store_position = np.split(store_position,np.cumsum(nendpoints)[:-1])
+    # assign HHs to bins: bin i+1 runs from the previous end-point to the current one
+    for i,position_iterate in enumerate(store_position):
+        bin_sizes = np.diff(position_iterate,prepend=0,append=nobs)
+        store_bins[i] = np.repeat(np.arange(1,len(bin_sizes)+1),bin_sizes)
+    return store_bins
+
+
 def generate_bins(endpoints,myvariable):
     """ Generates the partition of a sample.
 
@@ -18,53 +125,684 @@ def generate_bins(endpoints,myvariable):
          * store_bin: array containing to which bin belongs each observation.
 
      """
-    store_position = np.zeros(shape=len(endpoints))
-    store_bin = np.zeros(shape=len(myvariable))
-    for i,endpoints_iterate in enumerate(endpoints): 
-        # find who is the HH at the end-point of the bin
-        store_position[i] = [ n for n,ii in enumerate(myvariable) if ii>endpoints_iterate ][0]
-        # assign HHs to bins
-        if (i == 0):
-            store_bin[0:(int(store_position[i]))] = i+1
-        else:
-            store_bin[int(store_position[i-1]):(int(store_position[i]))] = i+1
-            
-    store_bin[store_bin==0] = len(endpoints)+1
+    store_bin = generate_bins_batch([endpoints],myvariable)[0]
     return store_bin
 
 
 
 
-def generate_densities(myweight,myvariable):
-    """ Computes the empirical pdf and cdf.
+def generate_ecdf(myweight,myvariable,mysortindex=None):
+    """ Computes the weighted empirical pdf and cdf together with the sort permutation.
+
+     The variable is sorted with a stable argsort, so ties keep their original order
+     instead of being broken by the weight.
 
      Args:
-         * myweights: array containing the population weights.
+         * myweight: array containing the population weights.
          * myvariable: array containing the variable.
+         * mysortindex (optional): array containing the permutation that sorts the variable,
+           e.g. from *generate_sort_index*. If given, the variable is not sorted again.
 
      Returns:
          * variable_pdf: array containing the empirical pdf.
          * variable_cdf: array containing the empirical cdf.
+         * variable_index_sorted: array containing the permutation that sorts the variable.
+           It can be reused to sort other columns (or a data frame with *take*) in the
+           same order as the pdf and cdf.
 
      """
 
-    # zip weights and variable
-    zipped_pairs= zip(myvariable, myweight)
+    if mysortindex is None:
+        mysortindex = np.argsort(np.asarray(myvariable),kind='stable')
+    variable_index_sorted = mysortindex
     # sort weights according to variable
-    weights_sorted = [x for _, x in sorted(zipped_pairs)]
+    weights_sorted = np.asarray(myweight,dtype=np.float64)[variable_index_sorted]
     # take cumulative sum - for normalization in case do not add up to one
     weights_cumsum = np.cumsum(weights_sorted)
     # compute pdf
     variable_pdf = weights_sorted/weights_cumsum[-1]
     # compute cdf
     variable_cdf = weights_cumsum/weights_cumsum[-1]
+    return variable_pdf, variable_cdf, variable_index_sorted
+
+
+def generate_densities(myweight,myvariable):
+    """ Computes the empirical pdf and cdf.
+
+     Args:
+         * myweights: array containing the population weights.
+         * myvariable: array containing the variable.
+
+     Returns:
+         * variable_pdf: array containing the empirical pdf.
+         * variable_cdf: array containing the empirical cdf.
+
+     """
+
+    variable_pdf, variable_cdf, _ = generate_ecdf(myweight,myvariable)
     return variable_pdf, variable_cdf
 
 
+def generate_histogram(myvariable,myweights,mybins,mykeep=None):
+    """ Computes a weighted histogram.
+
+     Args:
+         * myvariable: array containing the variable.
+         * myweights: array containing the population weights.
+         * mybins: number of bins, or array containing the bin edges.
+         * mykeep (optional): boolean array indicating the observations to include, e.g.
+           to trim the top of the distribution.
+
+     Returns:
+         * mycounts: array containing the weighted count of each bin.
+         * myedges: array containing the bin edges.
+
+     """
+
+    x = np.asarray(myvariable,dtype=np.float64)
+    w = np.asarray(myweights,dtype=np.float64)
+    if mykeep is not None:
+        x, w = x[mykeep], w[mykeep]
+    mycounts, myedges = np.histogram(x,bins=mybins,weights=w)
+    return mycounts, myedges
+
+
+def generate_linear_binning(myvariable,myweights,mygrid,mycodes=None,myngroups=1):
+    """ Spreads the weights of the observations over an equally spaced grid.
+
+     Each observation gives its weight to its two neighbouring grid points, in proportion to
+     how close it is to each of them. The weights of all the groups are accumulated with a
+     single *np.bincount*, using the cell code group*G + grid point.
+
+     Args:
+         * myvariable: array of shape (n,) containing the variable.
+         * myweights: array of shape (n,) containing the weights.
+         * mygrid: array of shape (G,) containing the equally spaced grid. Observations
+           outside the grid are given to the closest grid interval.
+         * mycodes (optional): integer array of shape (n,) containing the group (0 to
+           *myngroups*-1) of each observation.
+         * myngroups (optional): number of groups.
+
+     Returns:
+         * mybinned: array of shape (myngroups, G) containing the binned weights.
+
+     """
+
+    x = np.asarray(myvariable,dtype=np.float64)
+    w = np.asarray(myweights,dtype=np.float64)
+    gridsize = len(mygrid)
+    position = (x - mygrid[0])/(mygrid[1] - mygrid[0])
+    left = np.clip(np.floor(position).astype(np.int64),0,gridsize-2)
+    right_share = position - left
+    if mycodes is not None:
+        left = left + np.asarray(mycodes,dtype=np.int64)*gridsize
+    mybinned = np.bincount(np.concatenate((left,left+1)),
+                           weights=np.concatenate((w*(1-right_share),w*right_share)),
+                           minlength=myngroups*gridsize).reshape(myngroups,gridsize)
+    return mybinned
+
+
+def generate_kde(mydataset,myvariable,myweight,mygridsize=1024,mybandwidth=None,mygroup=None,
+                 mykeep=None):
+    """ Computes a weighted Gaussian kernel density estimate on a grid.
+
+     The weights are first spread over an equally spaced grid with *generate_linear_binning*,
+     and the binned weights are convolved with the kernel with the FFT, so the cost is
+     O(n + G log G) instead of O(n*G). The densities of all the groups come from the same
+     binned grid and the same bandwidth.
+
+     Args:
+         * mydataset: Data Frame containing the dataset.
+         * myvariable: string indicating the name of the variable.
+         * myweight: string indicating the name of the column that contains the weights.
+         * mygridsize (optional): number of grid points.
+         * mybandwidth (optional): bandwidth of the kernel. By default it is set with
+           Silverman's rule, 0.9*min(sd, IQR/1.34)*n**(-1/5), with the weighted standard
+           deviation and interquartile range and the effective number of observations.
+         * mygroup (optional): string indicating the name of the column that contains the
+           groups. Observations with a missing group only enter the overall density.
+         * mykeep (optional): boolean array indicating the observations to include, e.g.
+           to trim the top of the distribution.
+
+     Returns:
+         * mydensities: Data Frame indexed by the grid containing the density of the whole
+           sample (*density*) and, if *mygroup* is given, of each group (*density_<group>*).
+
+     """
+
+    if mykeep is not None:
+        mydataset = mydataset[np.asarray(mykeep)]
+    x = mydataset[myvariable].to_numpy(dtype=np.float64)
+    w = mydataset[myweight].to_numpy(dtype=np.float64)
+    if mybandwidth is None:
+        _, cdf, mysortindex = generate_ecdf(w,x)
+        q25, q75 = generate_weighted_quantiles(x[mysortindex],cdf,[0.25,0.75])
+        mean = np.sum(w*x)/np.sum(w)
+        sd = (np.sum(w*(x - mean)**2)/np.sum(w))**0.5
+        spread = min(sd,(q75 - q25)/1.34) if q75 > q25 else sd
+        mybandwidth = 0.9*spread*(np.sum(w)**2/np.sum(w**2))**(-0.2)
+    # -- grid, extended by three bandwidths on each side
+    mygrid = np.linspace(x.min() - 3*mybandwidth,x.max() + 3*mybandwidth,mygridsize)
+    delta = mygrid[1] - mygrid[0]
+    # -- binned weights: the groups first, then the observations without a group
+    if mygroup is None:
+        codes, groups = np.zeros(len(x),dtype=np.int64), []
+    else:
+        codes, groups = pd.factorize(mydataset[mygroup],sort=True)
+        codes = np.where(codes < 0,len(groups),codes)
+    mybinned = generate_linear_binning(x,w,mygrid,codes,len(groups)+1)
+    mybinned = np.vstack((mybinned.sum(axis=0),mybinned[:len(groups)]))
+    # -- Gaussian kernel at the grid offsets, up to four bandwidths, wrapped for the FFT
+    nkernel = min(mygridsize-1,int(np.ceil(4*mybandwidth/delta)))
+    fftsize = 2**int(np.ceil(np.log2(mygridsize + nkernel + 1)))
+    offsets = np.arange(-nkernel,nkernel+1)*delta/mybandwidth
+    mykernel = np.zeros(fftsize)
+    mykernel[np.arange(-nkernel,nkernel+1) % fftsize] = (np.exp(-offsets**2/2)
+                                                         /(np.sqrt(2*np.pi)*mybandwidth))
+    mydensities = np.fft.irfft(np.fft.rfft(mybinned,fftsize,axis=1)*np.fft.rfft(mykernel),
+                               fftsize,axis=1)[:,:mygridsize]
+    mydensities /= mybinned.sum(axis=1)[:,None]
+    mydensities = pd.DataFrame(mydensities.T,index=pd.Index(mygrid,name=myvariable),
+                               columns=['density'] + [f'density_{group}' for group in groups])
+    return mydensities
+
+
+def generate_weighted_quantiles(mysorted,mycdf,mylevels):
+    """ Computes many weighted quantiles at once from a precomputed cdf.
+
+     The quantile at level q is the smallest value whose cdf is at least q. All the levels
+     are located with one binary search over the cdf, so the cost is O(k log n) for k levels.
+
+     Args:
+         * mysorted: array of shape (n,) or (n, m) containing the sorted variable(s).
+         * mycdf: array of the same shape containing the weighted cdf(s), e.g. from
+           *generate_ecdf*.
+         * mylevels: array of shape (k,) containing the levels, between 0 and 1.
+
+     Returns:
+         * myquantiles: array of shape (k,) (or (k, m)) containing the quantiles.
+
+     """
+
+    sx = np.asarray(mysorted)
+    sx = sx.reshape(len(sx),-1)
+    cdf = np.asarray(mycdf).reshape(sx.shape)
+    mylevels = np.asarray(mylevels,dtype=np.float64)
+    myquantiles = np.empty((len(mylevels),sx.shape[1]),dtype=sx.dtype)
+    for j in range(sx.shape[1]):
+        # the last cdf value can be slightly below one because of rounding
+        position = np.minimum(np.searchsorted(cdf[:,j],mylevels,side='left'),len(sx)-1)
+        myquantiles[:,j] = sx[position,j]
+    if np.ndim(mysorted) == 1:
+        return myquantiles[:,0]
+    return myquantiles
+
+
+def generate_percentile_ranks(mysorted,mycdf,myvalues):
+    """ Computes in which percentile of the distribution are some values.
+
+     The rank of a value X is the weighted share of the population with a value lower
+     than or equal to X, i.e. the cdf at X.
+
+     Args:
+         * mysorted: array of shape (n,) or (n, m) containing the sorted variable(s).
+         * mycdf: array of the same shape containing the weighted cdf(s), e.g. from
+           *generate_ecdf*.
+         * myvalues: array of shape (k,) containing the values.
+
+     Returns:
+         * myranks: array of shape (k,) (or (k, m)) containing the ranks, between 0 and 1.
+
+     """
+
+    sx = np.asarray(mysorted)
+    sx = sx.reshape(len(sx),-1)
+    cdf = np.asarray(mycdf,dtype=np.float64).reshape(sx.shape)
+    myranks = np.empty((len(myvalues),sx.shape[1]))
+    for j in range(sx.shape[1]):
+        position = np.searchsorted(sx[:,j],myvalues,side='right')
+        # nobody below the value: the rank is zero
+        myranks[:,j] = np.concatenate(([0.0],cdf[:,j]))[position]
+    if np.ndim(mysorted) == 1:
+        return myranks[:,0]
+    return myranks
+
+
+
+
+
+def generate_concentration(myranking,myoutcomes,myweights,mysortindex=None,mygrid=None):
+    """ Computes the concentration indices and curves of outcomes ranked by another variable.
+
+     The concentration curve of an outcome is its Lorenz Curve when the population is ranked
+     by *myranking* instead of by the outcome itself. Observations with the same ranking value
+     are one group: their weights and outcomes are added up before the cumulative sums, so
+     the results do not depend on the order of the rows. All the outcomes share the sort of
+     the ranking variable and the groups, so they are computed with a single call to
+     *generate_gini_batch* over the groups.
+
+     Args:
+         * myranking: array of shape (n,) containing the ranking variable.
+         * myoutcomes: array of shape (n,) or (n, m) containing the outcome(s).
+         * myweights: array of shape (n,) containing the weights.
+         * mysortindex (optional): array containing the permutation that sorts the ranking
+           variable, e.g. from *generate_sort_index*. If given, it is not sorted again.
+         * mygrid (optional): array of shape (G,) containing the population shares where the
+           curves are evaluated, as in *generate_gini_batch*.
+
+     Returns:
+         * concentrationco: scalar (or array of shape (m,)) containing the concentration
+           index(es).
+         * concentrationcur: array of shape (k+1,) (or (k+1, m)) containing the
+           concentration curve(s) at every group of tied ranking values, with k the number
+           of groups, or of shape (G,) (or (G, m)) if *mygrid* is given.
+
+     """
+
+    r = np.asarray(myranking)
+    if mysortindex is None:
+        mysortindex = np.argsort(r,kind='stable')
+    y = np.asarray(myoutcomes,dtype=np.float64)
+    yy = y.reshape(len(y),-1)[mysortindex]
+    sw = np.asarray(myweights,dtype=np.float64)[mysortindex]
+    # -- one cell per (group of tied ranking values, outcome), all accumulated by a bincount
+    codes = generate_tie_groups(r[mysortindex])
+    ngroups, noutcomes = codes[-1] + 1, yy.shape[1]
+    cells = (codes[:,None]*noutcomes + np.arange(noutcomes)).ravel()
+    group_sums = np.bincount(cells,weights=(yy*sw[:,None]).ravel(),
+                             minlength=ngroups*noutcomes).reshape(ngroups,noutcomes)
+    group_weights = np.bincount(codes,weights=sw,minlength=ngroups)
+    group_means = np.divide(group_sums,group_weights[:,None],out=np.zeros_like(group_sums),
+                            where=group_weights[:,None] != 0)
+    # the groups are already in the order of the ranking
+    concentrationco, concentrationcur = generate_gini_batch(
+            group_means,group_weights,
+            np.broadcast_to(np.arange(ngroups)[:,None],(ngroups,noutcomes)),mygrid)
+    if y.ndim == 1:
+        return concentrationco[0], concentrationcur[:,0]
+    return concentrationco, concentrationcur
+
+
+def generate_cumulative_shares(myvariables,myweights,mysortindex=None):
+    """ Computes the cumulative population and variable shares of one or several distributions.
+
+     Args:
+         * myvariables: array of shape (n,) or (n, m) containing the variable(s). Each column
+           is sorted on its own.
+         * myweights: array of shape (n,) containing the weights, or of shape (n, m) with
+           the weights of each variable, e.g. replicate weights.
+         * mysortindex (optional): array of the same shape as *myvariables* containing the
+           permutations that sort each column, e.g. from *generate_sort_index*.
+
+     Returns:
+         * pci: array of shape (n, m) containing the cumulative population shares.
+         * pxi: array of shape (n, m) containing the cumulative shares of the variable(s).
+
+     """
+
+    x = np.asarray(myvariables,dtype=np.float64)
+    w = np.asarray(myweights,dtype=np.float64)
+    xx = x.reshape(len(x),-1)
+    if mysortindex is None:
+        sxw = np.argsort(xx,axis=0,kind='stable')
+    else:
+        sxw = np.asarray(mysortindex).reshape(xx.shape)
+    if w.ndim == 1:
+        sw = w[sxw]
+    else:
+        sw = np.take_along_axis(w,sxw,axis=0)
+    sx = np.take_along_axis(xx,sxw,axis=0)*sw
+    pxi = np.cumsum(sx,axis=0)
+    pxi /= pxi[-1]
+    pci = np.cumsum(sw,axis=0)
+    pci /= pci[-1]
+    return pci, pxi
+
+
+def generate_gini_batch(myvariables,myweights,mysortindex=None,mygrid=None,mycumulative=False):
+    """ Computes the Gini Coefficients and the Lorenz Curves of one or several distributions.
+
+     The coefficient is computed with the trapezoid form over the cumulative population
+     and variable shares, sum_i (pxi[i]*pci[i-1] - pci[i]*pxi[i-1]), fully on arrays and
+     accumulating in float64.
+
+     Args:
+         * myvariables: array of shape (n,) or (n, m) containing the variable(s) of which we
+           want to compute the statistics. Each column is sorted on its own.
+         * myweights: array of shape (n,) containing the weights to be applied to the variables,
+           or of shape (n, m) with the weights of each variable.
+         * mysortindex (optional): array of the same shape as *myvariables* containing the
+           permutations that sort each column, e.g. from *generate_sort_index*. If given,
+           the variables are not sorted again.
+         * mygrid (optional): array of shape (G,) containing population shares, e.g.
+           np.linspace(0, 1, 1001). If given, the Lorenz Curves are evaluated at these
+           weighted cumulative population shares (see *generate_lorenz_grid*), so their size
+           does not depend on the number of observations.
+         * mycumulative (optional): if True, also returns the cumulative shares, e.g. to
+           read the top shares off them with *generate_top_shares*.
+
+     Returns:
+         * ginico: scalar (or array of shape (m,)) containing the Gini Coefficient(s).
+         * lorenzcur: array of shape (n+1,) (or (n+1, m)) containing the Lorenz Curve(s) at
+           every observation, or of shape (G,) (or (G, m)) if *mygrid* is given.
+         * mycumulativeshares (only if mycumulative): tuple (pci, pxi) as returned by
+           *generate_cumulative_shares*.
+
+     """
+
+    pci, pxi = generate_cumulative_shares(myvariables,myweights,mysortindex)
+    ginico = np.sum(pxi[1:]*pci[:-1] - pci[1:]*pxi[:-1],axis=0)
+    if mygrid is None:
+        lorenzcur = np.concatenate((np.zeros((1,pxi.shape[1])),pxi))
+    else:
+        lorenzcur = generate_lorenz_grid(pci,pxi,mygrid)
+    if np.ndim(myvariables) == 1:
+        ginico, lorenzcur = ginico[0], lorenzcur[:,0]
+    if mycumulative:
+        return ginico, lorenzcur, (pci, pxi)
+    return ginico, lorenzcur
+
+
+def generate_top_shares(myvariables,myweights,mytops,mysortindex=None,myminobs=10,
+                        mycumulativeshares=None):
+    """ Computes the shares of the variable(s) held by the top of the distribution.
+
+     The share of the top p is one minus the Lorenz Curve at 1-p, read from the cumulative
+     shares of *generate_cumulative_shares* for all the levels at once. When the top p holds
+     fewer than *myminobs* observations, the sample does not support the level and the share
+     is interpolated with a Pareto tail: S(p) = S(p0)*(p/p0)**k, with k estimated from the
+     shares at p0, the finest supported level, and at 10*p0.
+
+     Args:
+         * myvariables: array of shape (n,) or (n, m) containing the variable(s).
+         * myweights: array of shape (n,) containing the weights.
+         * mytops: array of shape (k,) containing the top population shares, e.g. 0.01 for
+           the top 1%.
+         * mysortindex (optional): array of the same shape as *myvariables* containing the
+           permutations that sort each column.
+         * myminobs (optional): minimum number of observations in a supported top group.
+         * mycumulativeshares (optional): tuple (pci, pxi) of cumulative shares of the
+           variable(s), e.g. from *generate_gini_batch*. If given, they are not computed again.
+
+     Returns:
+         * topshares: array of shape (k,) (or (k, m)) containing the top shares.
+
+     """
+
+    if mycumulativeshares is None:
+        mycumulativeshares = generate_cumulative_shares(myvariables,myweights,mysortindex)
+    pci, pxi = mycumulativeshares
+    mytops = np.asarray(mytops,dtype=np.float64)
+    topshares = np.empty((len(mytops),pci.shape[1]))
+    for j in range(pci.shape[1]):
+        pc = np.concatenate(([0.0],pci[:,j]))
+        px = np.concatenate(([0.0],pxi[:,j]))
+        topshares[:,j] = 1 - np.interp(1 - mytops,pc,px)
+        # finest level supported by the sample, and the Pareto tail below it
+        p0 = 1 - pc[max(len(pc) - 1 - myminobs,0)]
+        p1 = min(10*p0,1.0)
+        s0, s1 = 1 - np.interp([1 - p0,1 - p1],pc,px)
+        unsupported = mytops < p0
+        if unsupported.any() and p1 > p0 and s0 > 0 and s1 > 0:
+            k = np.log(s1/s0)/np.log(p1/p0)
+            topshares[unsupported,j] = s0*(mytops[unsupported]/p0)**k
+    if np.ndim(myvariables) == 1:
+        return topshares[:,0]
+    return topshares
+
+
+def generate_inequality_indices(mydataset,myweight,myvariables,myepsilons=(0.5,1,2),
+                                mythetas=(-1,2),mysortcache=None):
+    """ Computes a suite of inequality indices for several variables at once.
+
+     All the indices come from one set of weighted moments per variable, computed on the
+     whole (n, m) array at once, and from one sort per variable for the percentile ratios.
+     The indices based on logarithms or powers (Theil, mean log deviation, Atkinson and
+     generalized entropy) are only defined for positive values: they are computed on the
+     observations with a positive value, and the weighted share of the others is reported
+     in the row *share_nonpositive*. The coefficient of variation and the percentile ratios
+     use all the observations; a ratio is missing if its denominator is not positive.
+
+     Args:
+         * mydataset: Data Frame containing the dataset.
+         * myweight: string indicating the name of the column that contains the weights.
+         * myvariables: list of strings indicating the variables.
+         * myepsilons (optional): inequality aversion parameters of the Atkinson indices.
+         * mythetas (optional): parameters of the generalized entropy indices, other than 0
+           (mean log deviation) and 1 (Theil).
+         * mysortcache (optional): dictionary used as cache by *generate_sort_index*.
+
+     Returns:
+         * myindices: Data Frame with one row per index and one column per variable.
+
+     """
+
+    x = mydataset[myvariables].to_numpy(dtype=np.float64)
+    w = mydataset[myweight].to_numpy(dtype=np.float64)
+    # -- moments of all the observations
+    wtotal = np.sum(w)
+    mean_all = w @ x / wtotal
+    variance_all = w @ (x - mean_all)**2 / wtotal
+    # -- moments of the positive observations: the others get zero weight
+    positive = x > 0
+    wp = np.where(positive, w[:,None], 0.0)
+    xp = np.where(positive, x, 1.0)
+    wp_total = np.sum(wp, axis=0)
+    mean_positive = np.sum(wp*xp, axis=0)/wp_total
+    relative = xp/mean_positive
+    log_relative = np.log(relative)
+    myindices = {'mean':mean_all,
+                 'share_nonpositive':1 - wp_total/wtotal,
+                 'cv':variance_all**0.5/mean_all,
+                 'theil':np.sum(wp*relative*log_relative, axis=0)/wp_total,
+                 'mld':-np.sum(wp*log_relative, axis=0)/wp_total}
+    for epsilon in myepsilons:
+        if epsilon == 1:
+            myindices[f'atkinson_{epsilon}'] = 1 - np.exp(np.sum(wp*log_relative, axis=0)/wp_total)
+        else:
+            myindices[f'atkinson_{epsilon}'] = 1 - (np.sum(wp*relative**(1 - epsilon), axis=0)
+                                                    / wp_total)**(1/(1 - epsilon))
+    for theta in mythetas:
+        myindices[f'ge_{theta}'] = ((np.sum(wp*relative**theta, axis=0)/wp_total - 1)
+                                    / (theta*(theta - 1)))
+    # -- percentile ratios from one sort per variable
+    quantiles = np.empty((4,len(myvariables)))
+    for j,variable in enumerate(myvariables):
+        if mysortcache is None:
+            mysortindex = np.argsort(x[:,j],kind='stable')
+        else:
+            mysortindex = generate_sort_index(mydataset,variable,mysortcache)
+        _, cdf, _ = generate_ecdf(w,x[:,j],mysortindex)
+        quantiles[:,j] = generate_weighted_quantiles(x[mysortindex,j],cdf,[0.1,0.5,0.9,0.99])
+    p10, p50, p90, p99 = quantiles
+    myindices['p90_p10'] = np.where(p10 > 0, p90/np.where(p10 > 0, p10, 1.0), np.nan)
+    myindices['p99_p50'] = np.where(p50 > 0, p99/np.where(p50 > 0, p50, 1.0), np.nan)
+    myindices = pd.DataFrame(myindices, index=myvariables).T
+    return myindices
+
+
+def generate_group_gini(mydataset,myvariable,myweight,mygroup,mygrid):
+    """ Computes the Gini Coefficient and the Lorenz Curve of a variable within every group.
+
+     The observations are sorted once by (group, variable) with *np.lexsort*, so every group
+     is a contiguous segment. The cumulative shares of all the groups come from a single
+     cumulative sum minus the running total at the start of each group, and the Gini terms
+     are added up by group with *np.bincount*. The Lorenz Curves of all the groups are
+     evaluated on the grid with a single *np.interp*, using 2*group + population share as
+     the key so that the segments do not overlap.
+
+     Args:
+         * mydataset: Data Frame containing the dataset.
+         * myvariable: string indicating the name of the variable.
+         * myweight: string indicating the name of the column that contains the weights.
+         * mygroup: string indicating the name of the column that contains the groups.
+           Observations with a missing group are left out.
+         * mygrid: array of shape (G,) containing the population shares where the Lorenz
+           Curves are evaluated.
+
+     Returns:
+         * myginis: Data Frame indexed by group containing the Gini Coefficient (*gini*), the
+           number of observations (*nobs*) and the total weight (*weight*) of each group.
+         * mylorenz: Data Frame indexed by group, with one row per group and grid point,
+           containing the population share (*population*) and the Lorenz Curve (*lorenz*).
+
+     """
+
+    codes, groups = pd.factorize(mydataset[mygroup],sort=True)
+    x = mydataset[myvariable].to_numpy(dtype=np.float64)
+    w = mydataset[myweight].to_numpy(dtype=np.float64)
+    keep = codes >= 0
+    codes, x, w = codes[keep], x[keep], w[keep]
+    myindex = pd.Index(np.asarray(groups),name=mygroup)
+    if myindex.dtype.kind in 'iub':
+        myindex = myindex.astype(np.int64)
+    ngroups = len(myindex)
+    order = np.lexsort((x,codes))
+    sc, sw = codes[order], w[order]
+    sx = x[order]*sw
+    # segmented cumulative sums: global cumulative sum minus the total before each group
+    starts = np.searchsorted(sc,np.arange(ngroups))
+    weight_totals = np.bincount(sc,weights=sw,minlength=ngroups)
+    variable_totals = np.bincount(sc,weights=sx,minlength=ngroups)
+    pci = np.cumsum(sw)
+    pci -= np.concatenate(([0.0],pci))[starts][sc]
+    pci /= weight_totals[sc]
+    pxi = np.cumsum(sx)
+    pxi -= np.concatenate(([0.0],pxi))[starts][sc]
+    pxi /= variable_totals[sc]
+    # previous cumulative shares, zero at the first observation of each group
+    first = np.zeros(len(sc),dtype=bool)
+    first[starts] = True
+    pci_previous = np.where(first,0.0,np.concatenate(([0.0],pci[:-1])))
+    pxi_previous = np.where(first,0.0,np.concatenate(([0.0],pxi[:-1])))
+    ginico = np.bincount(sc,weights=pxi*pci_previous - pci*pxi_previous,minlength=ngroups)
+    # Lorenz Curves of all the groups with one interpolation
+    keys = np.concatenate((2.0*np.arange(ngroups),2.0*sc + pci))
+    values = np.concatenate((np.zeros(ngroups),pxi))
+    keys_order = np.argsort(keys,kind='stable')
+    mygrid = np.asarray(mygrid,dtype=np.float64)
+    lorenzgrid = np.interp((2.0*np.arange(ngroups)[:,None] + mygrid).ravel(),
+                           keys[keys_order],values[keys_order])
+    myginis = pd.DataFrame({'gini':ginico,
+                            'nobs':np.bincount(sc,minlength=ngroups),
+                            'weight':weight_totals},index=myindex)
+    mylorenz = pd.DataFrame({'population':np.tile(mygrid,ngroups),'lorenz':lorenzgrid},
+                            index=myindex.repeat(len(mygrid)))
+    return myginis, mylorenz
+
+
+def generate_inequality_decomposition(mydataset,myvariable,myweight,mygroup):
+    """ Decomposes the Theil index and the Gini Coefficient of a variable by groups.
 
+     The Theil index is split additively into a within-group and a between-group part,
+     T = sum_g s_g*T_g + sum_g s_g*log(mu_g/mu), where s_g is the share of the variable held
+     by group g and mu_g its mean. It only uses the observations with a positive value.
+     The Gini Coefficient is split into a within-group part, sum_g a_g*s_g*G_g with a_g the
+     population share of group g, a between-group part, the Gini of the group means, and
+     the overlap between the groups, the remainder. Both decompositions only need the
+     weighted sums by group of *generate_group_aggregates* and the Gini Coefficients by
+     group of *generate_group_gini*.
+
+     Args:
+         * mydataset: Data Frame containing the dataset.
+         * myvariable: string indicating the name of the variable.
+         * myweight: string indicating the name of the column that contains the weights.
+         * mygroup: string indicating the name of the column that contains the groups.
+
+     Returns:
+         * mydecomposition: Data Frame with the rows *theil* and *gini* and the columns
+           *total*, *within*, *between* and *overlap* (missing for the Theil index).
+
+     """
+
+    # -- Theil index: sums of x and x*log(x) by group, over the positive observations
+    mypositive = mydataset.loc[mydataset[myvariable] > 0,[myvariable,myweight,mygroup]]
+    mypositive = mypositive.assign(xlogx=mypositive[myvariable]*np.log(mypositive[myvariable]))
+    _, mysums, _, myweights = generate_group_aggregates(mypositive,myweight,mygroup,mytotals=True)
+    group_means = mysums[myvariable]/myweights
+    group_shares = mysums[myvariable]/mysums[myvariable].sum()
+    total_mean = mysums[myvariable].sum()/myweights.sum()
+    theil_groups = mysums['xlogx']/mysums[myvariable] - np.log(group_means)
+    theil_within = np.sum(group_shares*theil_groups)
+    theil_between = np.sum(group_shares*np.log(group_means/total_mean))
+    # -- Gini Coefficient: all the observations
+    _, mysums, _, myweights = generate_group_aggregates(mydataset[[myvariable,myweight,mygroup]],
+                                                        myweight,mygroup,mytotals=True)
+    myginis, _ = generate_group_gini(mydataset,myvariable,myweight,mygroup,[0.0,1.0])
+    mygroups = mydataset[mygroup].notna()
+    gini_total, _ = generate_gini_batch(mydataset.loc[mygroups,myvariable],
+                                        mydataset.loc[mygroups,myweight])
+    gini_within = np.sum(myweights/myweights.sum()*mysums[myvariable]/mysums[myvariable].sum()
+                         *myginis['gini'])
+    gini_between, _ = generate_gini_batch(mysums[myvariable]/myweights,myweights)
+    mydecomposition = pd.DataFrame({'total':[theil_within + theil_between,gini_total],
+                                    'within':[theil_within,gini_within],
+                                    'between':[theil_between,gini_between],
+                                    'overlap':[np.nan,gini_total - gini_within - gini_between]},
+                                   index=['theil','gini'])
+    return mydecomposition
+
+
+def generate_source_decomposition(mydataset,mytotal,mysources,myweight,mysortindex=None):
+    """ Decomposes the Gini Coefficient of a total by its sources (Lerman and Yitzhaki, 1985).
+
+     With S_k the share of source k in the total, G_k its Gini Coefficient and R_k its Gini
+     correlation with the total, the Gini Coefficient of the total is sum_k S_k*R_k*G_k.
+     Every term is a covariance with a weighted rank, G = 2*cov(x, F)/mean(x), computed for
+     all the sources at once with matrix products. The concentration coefficients C_k = R_k*G_k
+     all use the single ranking of the total; only the Gini Coefficients of the sources need
+     the sources sorted, in one call for all of them. Observations with the same total share
+     its weighted mid-rank, so the results do not depend on the order of the rows.
+
+     Args:
+         * mydataset: Data Frame containing the dataset.
+         * mytotal: string indicating the name of the total, e.g. total income.
+         * mysources: list of strings indicating the sources. They should add up to the total.
+         * myweight: string indicating the name of the column that contains the weights.
+         * mysortindex (optional): array containing the permutation that sorts the total,
+           e.g. from *generate_sort_index*.
+
+     Returns:
+         * mydecomposition: Data Frame with one row per source containing its share in the
+           total (*share*), its Gini Coefficient (*gini*), its Gini correlation with the total
+           (*gini_correlation*), its concentration coefficient (*concentration*), its share in
+           the Gini Coefficient of the total (*contribution*) and the relative change of that
+           Gini Coefficient after a 1% increase of the source (*marginal_effect*).
+
+     """
+
+    x = mydataset[mysources].to_numpy(dtype=np.float64)
+    p = mydataset[myweight].to_numpy(dtype=np.float64)
+    p = p/np.sum(p)
+    mymeans = p @ x
+    # -- weighted mid-ranks of the total, one per group of tied totals, in the original order
+    total = mydataset[mytotal].to_numpy()
+    if mysortindex is None:
+        mysortindex = np.argsort(total,kind='stable')
+    total_codes = generate_tie_groups(total[mysortindex])
+    total_weights = np.bincount(total_codes,weights=p[mysortindex])
+    total_ranks = np.cumsum(total_weights) - total_weights/2
+    total_rank = generate_unsorted(mysortindex,total_ranks[total_codes])
+    myconcentration = 2*((p*total_rank) @ x)/mymeans - 1
+    # -- Gini Coefficients of the sources, from their own weighted mid-ranks. Ties within a
+    #    source need no mid-rank: they hold the same value, so their order does not matter.
+    sxw = np.argsort(x,axis=0,kind='stable')
+    sp = p[sxw]
+    source_rank = np.cumsum(sp,axis=0) - sp/2
+    myginis = 2*np.sum(sp*np.take_along_axis(x,sxw,axis=0)*source_rank,axis=0)/mymeans - 1
+    myshares = mymeans/np.sum(mymeans)
+    gini_total = np.sum(myshares*myconcentration)
+    mydecomposition = pd.DataFrame({'share':myshares,
+                                    'gini':myginis,
+                                    'gini_correlation':myconcentration/myginis,
+                                    'concentration':myconcentration,
+                                    'contribution':myshares*myconcentration/gini_total,
+                                    'marginal_effect':myshares*myconcentration/gini_total - myshares},
+                                   index=mysources)
+    return mydecomposition
 
 
-def generate_gini(myvariable, myweights, mynobs): 
+def generate_gini(myvariable, myweights, mynobs, mygrid=None): 
     """ Computes the Gini Coefficient and the Lorenz Curve for a distribution.
 
      Args:
@@ -72,6 +810,8 @@ def generate_gini(myvariable, myweights, mynobs):
          * mynobs: scalar that indicates the number of observations.
          * myweights: array containing weights to applied to the variables.
          * myvariable: array containing the variable of which we want to compute the statistics.
+         * mygrid (optional): array containing the population shares where the Lorenz Curve
+           is evaluated (see *generate_gini_batch*).
 
      Returns:
          * ginico: scalar containing the Gini Coefficient.
@@ -79,27 +819,161 @@ def generate_gini(myvariable, myweights, mynobs):
 
      """
 
-    x = myvariable
-    w = pd.Series(myweights).reset_index(drop=True)
-    n = mynobs
-    wxsum = sum(w * x)
-    wsum = sum(w)
-    sxw = np.argsort(x)
-    sx = x[sxw] * w[sxw]
-    sw = w[sxw]
-    pxi = np.cumsum(sx) / wxsum
-    pci = np.cumsum(sw) / wsum
-    ginico = 0.0
-    for i in np.arange(1, n):
-        ginico = ginico + pxi.iloc[i] * pci.iloc[i - 1] - pci.iloc[i] * pxi.iloc[i - 1]
-        
-    lorenzcur_step = pxi
-    lorenzcur = np.concatenate(([0],lorenzcur_step))
-    
+    ginico, lorenzcur = generate_gini_batch(np.asarray(myvariable)[:mynobs],
+                                            np.asarray(myweights)[:mynobs],
+                                            mygrid=mygrid)
     return ginico, lorenzcur
 
 
 
+def generate_group_aggregates(mydataset,myweight,mygroup=None,mytotals=False):
+    """ Computes the weighted averages of all the variables for all the groups in one pass.
+
+     Every observation gets a cell code (group, variable) and a single *np.bincount* call
+     accumulates the weighted sums of the whole data frame. The averages are the weighted
+     sums divided by the total weight of each group.
+
+     Args:
+         * mydataset: Data Frame containing the dataset.
+         * myweight: string indicating the name of the column that contains the weights.
+         * mygroup (optional): string indicating by which group we want to compute the averages.
+           Observations with a missing group are left out, as in *groupby*.
+         * mytotals (optional): if True, also returns the weighted sums, the number of
+           observations and the total weight of each group.
+
+     Returns:
+         * myaverages: Data Frame containing the averages of each variable for each group (if any).
+         * mysums (only if mytotals): Data Frame containing the weighted sums of each variable
+           for each group.
+         * mycounts (only if mytotals): Series containing the number of observations of each group.
+         * myweights (only if mytotals): Series containing the total weight of each group.
+
+     """
+
+    myvariables = list(mydataset)
+    values = mydataset.to_numpy(dtype=np.float64)
+    weights = mydataset[myweight].to_numpy(dtype=np.float64)
+    if mygroup is None:
+        codes = np.zeros(len(mydataset),dtype=np.intp)
+        myindex = pd.RangeIndex(1,2)
+    else:
+        codes, groups = pd.factorize(mydataset[mygroup],sort=True)
+        keep = codes >= 0
+        codes, values, weights = codes[keep], values[keep], weights[keep]
+        myindex = pd.Index(np.asarray(groups))
+        if myindex.dtype.kind in 'iub':
+            myindex = myindex.astype(np.int64)
+    ngroups, nvariables = len(myindex), len(myvariables)
+    # one cell per (group, variable) pair, all accumulated by a single bincount
+    cells = (codes[:,None]*nvariables + np.arange(nvariables)).ravel()
+    weighted_sums = np.bincount(cells,weights=(values*weights[:,None]).ravel(),
+                                minlength=ngroups*nvariables).reshape(ngroups,nvariables)
+    weight_totals = np.bincount(codes,weights=weights,minlength=ngroups)
+    myaverages = pd.DataFrame(weighted_sums/weight_totals[:,None],columns=myvariables,index=myindex)
+    if not mytotals:
+        return myaverages
+    mysums = pd.DataFrame(weighted_sums,columns=myvariables,index=myindex)
+    mycounts = pd.Series(np.bincount(codes,minlength=ngroups),index=myindex)
+    myweights = pd.Series(weight_totals,index=myindex)
+    return myaverages, mysums, mycounts, myweights
+
+
+def generate_joint_distribution(mydataset,myweight,myrows,mycolumns,mynrows,myncolumns):
+    """ Computes the joint distribution of two partitions of the sample.
+
+     Every observation gets a cell code from its two bins, and *generate_group_aggregates*
+     computes the population and the averages of all the cells with a single *np.bincount*.
+
+     Args:
+         * mydataset: Data Frame containing the dataset.
+         * myweight: string indicating the name of the column that contains the weights.
+         * myrows: array containing the bin (1 to *mynrows*) of each observation in the first
+           partition, in the order of *mydataset*.
+         * mycolumns: array containing the bin (1 to *myncolumns*) of each observation in the
+           second partition, in the order of *mydataset*.
+         * mynrows: number of bins of the first partition.
+         * myncolumns: number of bins of the second partition.
+
+     Returns:
+         * myshares: Data Frame of shape (mynrows, myncolumns) containing the share of the
+           population in each cell.
+         * mymeans: Data Frame with one row per cell containing the bins (*row*, *column*)
+           and the averages of all the variables. Empty cells are missing.
+
+     """
+
+    mycells = (np.asarray(myrows,dtype=np.int64) - 1)*myncolumns + np.asarray(mycolumns) - 1
+    myaverages, _, _, myweights = generate_group_aggregates(mydataset.assign(joint_cell=mycells),
+                                                            myweight,'joint_cell',mytotals=True)
+    allcells = pd.RangeIndex(mynrows*myncolumns)
+    myweights = myweights.reindex(allcells,fill_value=0.0)
+    myshares = pd.DataFrame((myweights/myweights.sum()).to_numpy().reshape(mynrows,myncolumns),
+                            index=pd.RangeIndex(1,mynrows+1),columns=range(1,myncolumns+1))
+    mymeans = myaverages.drop(columns='joint_cell').reindex(allcells)
+    mymeans.insert(0,'row',allcells//myncolumns + 1)
+    mymeans.insert(1,'column',allcells%myncolumns + 1)
+    return myshares, mymeans
+
+
+def generate_prefix_index(mydataset,myweight,mykey):
+    """ Builds the cumulative weighted sums of a sorted data frame.
+
+     The index is built once per sort order. Afterwards the weighted average of every
+     variable over any contiguous range of rows costs two lookups (see
+     *generate_bin_averages*), so sweeping many sets of bin end points does not rescan
+     the sample.
+
+     Args:
+         * mydataset: Data Frame containing the dataset, sorted by *mykey*.
+         * myweight: string indicating the name of the column that contains the weights.
+         * mykey: string indicating the name of the column by which the data frame is sorted
+           and against which the bin end points are compared (e.g. a cdf or the age).
+
+     Returns:
+         * myprefixindex: dictionary containing the names of the variables, the sorted key and
+           the cumulative weighted sums and weights, both with a leading row of zeros.
+
+     """
+
+    values = mydataset.to_numpy(dtype=np.float64)
+    weights = mydataset[myweight].to_numpy(dtype=np.float64)
+    weighted_cumsum = np.zeros((len(mydataset)+1,values.shape[1]))
+    np.cumsum(values*weights[:,None],axis=0,out=weighted_cumsum[1:])
+    weight_cumsum = np.zeros(len(mydataset)+1)
+    np.cumsum(weights,out=weight_cumsum[1:])
+    myprefixindex = {'variables':list(mydataset),
+                     'key':mydataset[mykey].to_numpy(),
+                     'weighted_cumsum':weighted_cumsum,
+                     'weight_cumsum':weight_cumsum}
+    return myprefixindex
+
+
+def generate_bin_averages(myprefixindex,endpoints):
+    """ Computes the weighted averages of all the variables for each bin of a partition.
+
+     The bins are the same as in *generate_bins*. Their end rows are found with a binary
+     search over the sorted key, and then each bin costs two lookups in the cumulative sums.
+
+     Args:
+         * myprefixindex: dictionary returned by *generate_prefix_index*.
+         * endpoints: array containing the increasing end points of the bins.
+
+     Returns:
+         * myaverages: Data Frame containing the averages of each variable for each bin,
+           with the same layout as *generate_averages*.
+
+     """
+
+    store_position = np.searchsorted(myprefixindex['key'],endpoints,side='right')
+    store_position = np.concatenate(([0],store_position,[len(myprefixindex['key'])]))
+    weighted_sums = np.diff(myprefixindex['weighted_cumsum'][store_position],axis=0)
+    weight_totals = np.diff(myprefixindex['weight_cumsum'][store_position])
+    myaverages = pd.DataFrame(weighted_sums/weight_totals[:,None],
+                              columns=myprefixindex['variables'],
+                              index=range(1,len(store_position)))
+    return myaverages
+
+
 def generate_averages(mydataset,myweight,mygroup=None):
     """ Computes the averages of multiple variables for a given group.
 
@@ -113,16 +987,370 @@ def generate_averages(mydataset,myweight,mygroup=None):
 
      """
 
-    myvariables = list(mydataset)
+    myaverages = generate_group_aggregates(mydataset,myweight,mygroup)
+    return myaverages
+
+
+def generate_ratios(mytable,myratios):
+    """ Expresses some variables of a table as a percentage of another variable.
+
+     Args:
+         * mytable: Data Frame containing the averages of each variable for each group.
+         * myratios: dictionary whose keys are the names of the denominators and whose
+           values are the lists of variables to express as a percentage of them.
+
+     Returns:
+         * myratiotable: copy of *mytable* with the variables replaced by the percentages.
+
+     """
+
+    myratiotable = mytable.copy()
+    for denominator_iterate,variables_iterate in myratios.items():
+        for variable_iterate in variables_iterate:
+            myratiotable[variable_iterate] = mytable[variable_iterate]/mytable[denominator_iterate]*100
+    return myratiotable
+
+
+def generate_partition_statistics(mydataset,myweight,mypartitions,mygini):
+    """ Computes the averages by partition and the Gini Coefficients of a dataset.
+
+     This is the chain of kernels of the *analysis step* (sort permutations, cdfs, bins,
+     prefix sums and Gini) packed in one function, so that it can be run on subsets of the
+     sample, e.g. on each implicate of the survey in a process pool.
+
+     Args:
+         * mydataset: Data Frame containing the dataset.
+         * myweight: string indicating the name of the column that contains the weights.
+         * mypartitions: dictionary whose keys are the names of the tables and whose values
+           are tuples (column, end points, on_cdf). If on_cdf is True the end points are
+           population shares compared with the weighted cdf of the column, otherwise they
+           are compared with the column itself.
+         * mygini: list of strings with the columns of which we want the Gini Coefficient.
+
+     Returns:
+         * mystatistics: dictionary containing *average_total*, one table of averages for
+           each partition and one *gini_<column>* scalar for each column in *mygini*.
+
+     """
+
+    sort_cache = {}
+    weights = mydataset[myweight].to_numpy(dtype=np.float64)
+    mystatistics = {'average_total':generate_averages(mydataset,myweight)}
+    for name,(column,endpoints,on_cdf) in mypartitions.items():
+        mysortindex = generate_sort_index(mydataset,column,sort_cache)
+        myprefixindex = generate_prefix_index(mydataset.take(mysortindex),myweight,column)
+        if on_cdf:
+            # compare the end points with the cdf instead of the sorted column
+            _, myprefixindex['key'], _ = generate_ecdf(weights,mydataset[column],mysortindex)
+        mystatistics[name] = generate_bin_averages(myprefixindex,endpoints)
+    if mygini:
+        mysortindex = np.column_stack([generate_sort_index(mydataset,column,sort_cache)
+                                       for column in mygini])
+        ginico, _ = generate_gini_batch(mydataset[mygini].to_numpy(),weights,mysortindex)
+        for column,ginico_iterate in zip(mygini,ginico):
+            mystatistics['gini_'+column] = ginico_iterate
+    return mystatistics
+
+
+def generate_parallel_map(myfunction,myarguments,mymaxworkers=None):
+    """ Applies a function to each element of a list in a pool of processes.
+
+     The workers are forked, so that the scripts of the project, which run at import
+     time, are not executed again in each worker. Where forking is not available the
+     function is applied serially.
+
+     Args:
+         * myfunction: function to apply. It must be defined at the top level of a module.
+         * myarguments: list with the argument of each call.
+         * mymaxworkers (optional): maximum number of processes. By default, one per core.
+
+     Returns:
+         * myresults: list with the result of each call, in the order of *myarguments*.
+
+     """
+
+    if 'fork' not in multiprocessing.get_all_start_methods() or mymaxworkers == 1:
+        return [myfunction(argument) for argument in myarguments]
+    with ProcessPoolExecutor(max_workers=mymaxworkers,
+                             mp_context=multiprocessing.get_context('fork')) as executor:
+        myresults = list(executor.map(myfunction,myarguments))
+    return myresults
+
+
+def generate_rubin(myestimates,myvariances=None):
+    """ Combines the estimates of several implicates with Rubin's rules.
+
+     The point estimate is the mean over implicates and the total variance is
+     W + (1 + 1/m) B, where W is the average within-implicate variance and B the
+     between-implicate variance of the estimates.
+
+     Args:
+         * myestimates: list with the estimate of each implicate (scalars, arrays or Data
+           Frames with the same layout).
+         * myvariances (optional): list with the sampling variance of each estimate. If it
+           is not given, W is zero and only the imputation variance is returned.
+
+     Returns:
+         * myestimate: combined point estimate.
+         * myvariance: total variance of the combined estimate.
+
+     """
+
+    nimplicates = len(myestimates)
+    estimates = np.stack([np.asarray(estimate,dtype=np.float64) for estimate in myestimates])
+    myestimate = estimates.mean(axis=0)
+    between_variance = estimates.var(axis=0,ddof=1)
+    within_variance = 0.0
+    if myvariances is not None:
+        within_variance = np.stack([np.asarray(variance,dtype=np.float64)
+                                    for variance in myvariances]).mean(axis=0)
+    myvariance = within_variance + (1+1/nimplicates)*between_variance
+    if isinstance(myestimates[0],pd.DataFrame):
+        myestimate = pd.DataFrame(myestimate,index=myestimates[0].index,
+                                  columns=myestimates[0].columns)
+        myvariance = pd.DataFrame(myvariance,index=myestimates[0].index,
+                                  columns=myestimates[0].columns)
+    return myestimate, myvariance
+
+
+def generate_replicate_weights(myids,myreplicateids,myweights,mymultiplicities):
+    """ Arranges the replicate weights of the survey as a matrix aligned with the dataset.
+
+     The replicate weight file has one row per household, while the dataset has one row per
+     implicate. Every row of the dataset gets the replicate weights of its household, the
+     product of the weights and the multiplicity factors. Missing weights or factors are set
+     to zero, so that they do not spread to the whole replicate.
+
+     Args:
+         * myids: array of shape (n,) containing the household of each row of the dataset.
+         * myreplicateids: array of shape (h,) containing the household of each row of the
+           replicate weight file.
+         * myweights: array of shape (h, R) containing the replicate weights.
+         * mymultiplicities: array of shape (h, R) containing the multiplicity factors.
+
+     Returns:
+         * myreplicateweights: array of shape (n, R) containing the replicate weights.
+
+     """
+
+    myrows = pd.Index(myreplicateids).get_indexer(myids)
+    if (myrows < 0).any():
+        raise ValueError("Some households have no replicate weights.")
+    myreplicateweights = np.nan_to_num(np.asarray(myweights,dtype=np.float64)[myrows]
+                                       * np.asarray(mymultiplicities,dtype=np.float64)[myrows])
+    return myreplicateweights
+
+
+def generate_replicate_averages(mydataset,myreplicateweights,mygroup=None):
+    """ Computes the weighted averages of all the variables for all the groups and all the
+     replicate weights at once.
+
+     For each group, the weighted sums of all variables under all replicates are a single
+     matrix product X_g' W_g, so the averages are not computed again for each replicate.
+
+     Args:
+         * mydataset: Data Frame containing the dataset.
+         * myreplicateweights: array of shape (n, R) containing the replicate weights.
+         * mygroup (optional): array containing the group of each observation.
+
+     Returns:
+         * myaverages: Data Frame with one row per (replicate, group) pair, indexed by a
+           MultiIndex with levels *replicate* and *group*, containing the averages of each
+           variable.
+
+     """
+
+    values = mydataset.to_numpy(dtype=np.float64)
+    weights = np.asarray(myreplicateweights,dtype=np.float64)
     if mygroup is None:
-        myaverages = pd.DataFrame(columns=myvariables,index=range(1,2))
-        for variable_iterate in myvariables:
-            myaverages[variable_iterate] = np.average(mydataset[variable_iterate],weights=mydataset[myweight])
+        codes, groups = np.zeros(len(mydataset),dtype=np.intp), np.array([1])
     else:
-        myaverages = pd.DataFrame(columns=myvariables,index=range(1,(len(np.unique(mydataset[mygroup]))+1)))
-        for variable_iterate in myvariables:
-            myaverages[variable_iterate] = mydataset.groupby(mygroup).apply(lambda mydataset: 
-                np.average(mydataset[variable_iterate],weights=mydataset[myweight]))
+        codes, groups = pd.factorize(np.asarray(mygroup),sort=True)
+    nreplicates = weights.shape[1]
+    averages = np.empty((nreplicates,len(groups),values.shape[1]))
+    for g in range(len(groups)):
+        in_group = codes == g
+        weights_group = weights[in_group]
+        averages[:,g,:] = (values[in_group].T @ weights_group / weights_group.sum(axis=0)).T
+    myindex = pd.MultiIndex.from_product([range(1,nreplicates+1),np.asarray(groups).tolist()],
+                                         names=['replicate','group'])
+    myaverages = pd.DataFrame(averages.reshape(-1,values.shape[1]),index=myindex,
+                              columns=list(mydataset))
     return myaverages
-   
-        
\ No newline at end of file
+
+
+def generate_gini_replicates(myvariable,myreplicateweights,mysortindex=None,myblocksize=128):
+    """ Computes the Gini Coefficient of a variable under each replicate weight.
+
+     The variable is sorted once and the sort permutation is reused for all the replicates.
+     Each block of replicates is one call to *generate_gini_batch*, with one column of the
+     variable per replicate, so that memory stays bounded.
+
+     Args:
+         * myvariable: array of shape (n,) containing the variable.
+         * myreplicateweights: array of shape (n, R) containing the replicate weights.
+         * mysortindex (optional): array containing the permutation that sorts the variable.
+         * myblocksize (optional): number of replicates processed at a time.
+
+     Returns:
+         * ginico: array of shape (R,) containing the Gini Coefficient of each replicate.
+
+     """
+
+    x = np.asarray(myvariable,dtype=np.float64)
+    if mysortindex is None:
+        mysortindex = np.argsort(x,kind='stable')
+    mysortindex = np.asarray(mysortindex)
+    nreplicates = myreplicateweights.shape[1]
+    ginico = np.empty(nreplicates)
+    for start in range(0,nreplicates,myblocksize):
+        weights_block = np.asarray(myreplicateweights[:,start:start+myblocksize])
+        nblock = weights_block.shape[1]
+        ginico[start:start+nblock], _ = generate_gini_batch(
+                np.broadcast_to(x[:,None],(len(x),nblock)),weights_block,
+                np.broadcast_to(mysortindex[:,None],(len(x),nblock)))
+    return ginico
+
+
+def generate_replicate_variance(myestimate,myreplicates):
+    """ Computes the sampling variance of an estimate from its replicate estimates.
+
+     The variance is the mean over replicates of the squared deviation of each replicate
+     estimate from the full-sample estimate.
+
+     Args:
+         * myestimate: scalar, or Data Frame with one row per group, containing the
+           full-sample estimate.
+         * myreplicates: array of shape (R,), or Data Frame indexed by (replicate, group) as
+           returned by *generate_replicate_averages*, containing the replicate estimates.
+
+     Returns:
+         * myvariance: variance with the same layout as *myestimate*.
+
+     """
+
+    if isinstance(myestimate,pd.DataFrame):
+        deviations = myreplicates[list(myestimate)].sub(myestimate,level='group')
+        myvariance = (deviations**2).groupby(level='group').mean()
+        myvariance.index = myestimate.index
+        return myvariance
+    myvariance = np.mean((np.asarray(myreplicates)-myestimate)**2)
+    return myvariance
+
+
+def generate_lorenz_grid(mypopulation,myshares,mygrid):
+    """ Evaluates a Lorenz Curve on a fixed grid of population shares.
+
+     Args:
+         * mypopulation: array of shape (n,) or (n, m) containing the cumulative population
+           shares of the sorted observations.
+         * myshares: array of the same shape containing the cumulative shares of the variable.
+         * mygrid: array of shape (G,) containing the population shares where the curve is
+           evaluated.
+
+     Returns:
+         * lorenzgrid: array of shape (G,) (or (G, m)) containing the Lorenz Curve(s),
+           interpolated linearly between observations and starting at (0, 0).
+
+     """
+
+    pc = np.asarray(mypopulation).reshape(len(mypopulation),-1)
+    px = np.asarray(myshares).reshape(pc.shape)
+    lorenzgrid = np.column_stack([np.interp(mygrid,np.concatenate(([0.0],pc[:,j])),
+                                            np.concatenate(([0.0],px[:,j])))
+                                  for j in range(pc.shape[1])])
+    if np.ndim(myshares) == 1:
+        return lorenzgrid[:,0]
+    return lorenzgrid
+
+
+def generate_bootstrap_block(myblock):
+    """ Computes the Gini Coefficients and Lorenz Curves of a block of bootstrap draws.
+
+     Each draw re-draws the weights only, so the variables keep the order computed once, and
+     computes the statistics with *generate_gini_batch*.
+
+     Args:
+         * myblock: tuple (variables, weights, sort permutations, cluster codes, number of
+           clusters, seeds, method, grid) as prepared by *generate_gini_bootstrap*.
+
+     Returns:
+         * ginico: array of shape (draws, m) containing the Gini Coefficients.
+         * lorenzgrid: array of shape (draws, G, m) containing the Lorenz Curves on the grid.
+
+     """
+
+    xx, w, sxw, codes, nclusters, myseeds, mymethod, mygrid = myblock
+    ginico = np.empty((len(myseeds),xx.shape[1]))
+    lorenzgrid = np.empty((len(myseeds),len(mygrid),xx.shape[1]))
+    for d,seed_iterate in enumerate(myseeds):
+        rng = np.random.default_rng(seed_iterate)
+        if mymethod == 'bayesian':
+            mydraw = rng.standard_exponential(nclusters)
+        else:
+            mydraw = np.bincount(rng.integers(0,nclusters,nclusters),
+                                 minlength=nclusters).astype(np.float64)
+        # the draw is per cluster, so every row of a cluster and every variable get the same draw
+        ginico[d], lorenzgrid[d] = generate_gini_batch(xx,w*mydraw[codes],sxw,mygrid)
+    return ginico, lorenzgrid
+
+
+def generate_gini_bootstrap(myvariables,myweights,mydraws,myseed,mygrid,mysortindex=None,
+                            mymethod='bayesian',mylevel=0.95,mymaxworkers=None,mycodes=None):
+    """ Computes bootstrap confidence intervals for Gini Coefficients and Lorenz Curves.
+
+     The variables are sorted once. Each draw only re-draws the weights, either with the
+     Bayesian bootstrap (exponential multipliers) or with multinomial counts, so that no
+     draw needs its own sort. The weights are re-drawn per cluster (e.g. per household, whose
+     implicates are several rows): all the rows of a cluster get the same draw. Draw d is
+     seeded with the d-th child of *myseed*, so the results do not depend on how the draws
+     are split among the processes.
+
+     Args:
+         * myvariables: array of shape (n,) or (n, m) containing the variable(s).
+         * myweights: array of shape (n,) containing the weights.
+         * mydraws: number of bootstrap draws.
+         * myseed: integer seed of the whole bootstrap.
+         * mygrid: array of shape (G,) containing the population shares where the Lorenz
+           Curves are evaluated.
+         * mysortindex (optional): array of the same shape as *myvariables* containing the
+           permutations that sort each column.
+         * mymethod (optional): 'bayesian' or 'multinomial'.
+         * mylevel (optional): confidence level of the percentile intervals.
+         * mymaxworkers (optional): maximum number of processes.
+         * mycodes (optional): array of shape (n,) containing the cluster of each row. By
+           default each row is its own cluster.
+
+     Returns:
+         * gini_interval: array of shape (2,) (or (2, m)) containing the lower and upper
+           bounds of the Gini Coefficient(s).
+         * lorenz_interval: array of shape (2, G) (or (2, G, m)) containing the lower and
+           upper bounds of the Lorenz Curve(s) at each grid point.
+
+     """
+
+    x = np.asarray(myvariables,dtype=np.float64)
+    xx = x.reshape(len(x),-1)
+    w = np.asarray(myweights,dtype=np.float64)
+    if mysortindex is None:
+        sxw = np.argsort(xx,axis=0,kind='stable')
+    else:
+        sxw = np.asarray(mysortindex).reshape(xx.shape)
+    if mycodes is None:
+        codes = np.arange(len(xx))
+    else:
+        codes = pd.factorize(np.asarray(mycodes))[0]
+    nclusters = codes.max() + 1
+    myseeds = np.random.SeedSequence(myseed).spawn(mydraws)
+    nblocks = min(mydraws,mymaxworkers or multiprocessing.cpu_count())
+    myblocks = [(xx,w,sxw,codes,nclusters,seeds_iterate,mymethod,mygrid)
+                for seeds_iterate in np.array_split(np.array(myseeds,dtype=object),nblocks)]
+    myresults = generate_parallel_map(generate_bootstrap_block,myblocks,mymaxworkers)
+    ginico = np.concatenate([result[0] for result in myresults])
+    lorenzgrid = np.concatenate([result[1] for result in myresults])
+    mypercentiles = [50*(1-mylevel),50*(1+mylevel)]
+    gini_interval = np.percentile(ginico,mypercentiles,axis=0)
+    lorenz_interval = np.percentile(lorenzgrid,mypercentiles,axis=0)
+    if x.ndim == 1:
+        return gini_interval[:,0], lorenz_interval[:,:,0]
+    return gini_interval, lorenz_interval
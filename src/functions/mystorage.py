@@ -0,0 +1,413 @@
+"""
+The module *mystorage* contains the functions used to read and write data on disk.
+
+The raw survey is stored in *Stata* format, which is slow to parse and holds many more
+columns than the ones we use. The first time a column of a given file is requested, it is
+converted to a columnar cache with one raw binary file per column, keyed by the hash of
+the source file. The conversion reads only the requested columns and streams the file in
+chunks, so memory scales with the projected columns and not with the whole extract. Later
+runs memory-map the cached columns, and the *Stata* file is parsed again only when it
+changes.
+
+The steps of the project hand data to each other through *artifacts*: single files with
+named, typed entries. A JSON header describes the entries and is followed by aligned raw
+buffers. Arrays and the columns of large data frames are stored as buffers that can be
+memory-mapped, small tables as one record array, and scalars inside the header. Readers
+open an artifact lazily and load only the entries they ask for. A data frame sorted in
+several orders is stored once: each order is a *view*, kept as an int32 permutation plus
+the per-row columns derived in that order, and is rebuilt when it is read.
+
+"""
+
+
+import hashlib
+import json
+import os
+import shutil
+
+import numpy as np
+import pandas as pd
+
+
+ARTIFACT_MAGIC = b"SFCART01"
+ARTIFACT_ALIGNMENT = 64
+ARTIFACT_RECORDS_MAX_ROWS = 10000
+
+
+def hash_file(mypath,mychunksize=2**20):
+    """ Computes the SHA-256 hash of a file, reading it in chunks.
+
+     Args:
+         * mypath: string containing the path to the file.
+         * mychunksize (optional): number of bytes read at a time.
+
+     Returns:
+         * myhash: string containing the hexadecimal digest of the file.
+
+     """
+
+    myhash = hashlib.sha256()
+    with open(mypath,"rb") as in_file:
+        for chunk in iter(lambda: in_file.read(mychunksize),b""):
+            myhash.update(chunk)
+    return myhash.hexdigest()
+
+
+def write_columns_cache(mychunks,mycachedir,mymanifest):
+    """ Appends a stream of data frame chunks to one raw binary file per column.
+
+     If a later chunk needs a wider dtype than the previous ones (e.g. an integer column
+     that turns to float because of missing values), the part already written is
+     converted once. Non-numeric columns are stored as fixed-width unicode so that they
+     can be memory-mapped as well. The manifest is updated only after all the chunks are
+     written, so an interrupted conversion is never mistaken for a complete cache.
+
+     Args:
+         * mychunks: iterable of Data Frames with the same columns.
+         * mycachedir: string containing the directory where the columns are written.
+         * mymanifest: dictionary with the number of observations and the columns already
+           in the cache. It is updated in place and saved.
+
+     """
+
+    os.makedirs(mycachedir,exist_ok=True)
+    new_columns = {}
+    nobs = 0
+    for chunk in mychunks:
+        for column_iterate in chunk.columns:
+            values = chunk[column_iterate].to_numpy()
+            if values.dtype.kind not in 'biuf':
+                values = chunk[column_iterate].astype(str).to_numpy(dtype=str)
+            if column_iterate not in new_columns:
+                file_name = f"{len(mymanifest['columns'])+len(new_columns)}.bin"
+                new_columns[column_iterate] = {'file':file_name,'dtype':values.dtype.str}
+                open(os.path.join(mycachedir,file_name),"wb").close()
+            column_entry = new_columns[column_iterate]
+            column_path = os.path.join(mycachedir,column_entry['file'])
+            column_dtype = np.result_type(np.dtype(column_entry['dtype']),values.dtype)
+            if column_dtype != np.dtype(column_entry['dtype']):
+                written = np.fromfile(column_path,dtype=column_entry['dtype'])
+                written.astype(column_dtype).tofile(column_path)
+                column_entry['dtype'] = column_dtype.str
+            with open(column_path,"ab") as out_file:
+                values.astype(column_dtype,copy=False).tofile(out_file)
+        nobs += len(chunk)
+    if mymanifest['columns'] and new_columns and nobs != mymanifest['nobs']:
+        raise ValueError(f"Expected {mymanifest['nobs']} observations, read {nobs}.")
+    if new_columns:
+        mymanifest['nobs'] = nobs
+    mymanifest['columns'].update(new_columns)
+    manifest_path = os.path.join(mycachedir,"manifest.json")
+    with open(manifest_path+".tmp","w") as out_file:
+        json.dump(mymanifest,out_file)
+    os.replace(manifest_path+".tmp",manifest_path)
+
+
+def read_stata_chunks(mypath,mycolumns,mychunksize):
+    """ Reads only some columns of a *Stata* file, chunk by chunk.
+
+     Args:
+         * mypath: string containing the path to the *Stata* file.
+         * mycolumns: list of strings containing the names of the columns needed.
+         * mychunksize: number of observations read at a time.
+
+     Returns:
+         * mychunks: generator of Data Frames with the columns in *mycolumns*.
+
+     """
+
+    with pd.read_stata(mypath,columns=mycolumns,chunksize=mychunksize) as reader:
+        for chunk in reader:
+            yield chunk
+
+
+def read_stata_varlist(mypath):
+    """ Reads the names of the columns of a *Stata* file, without reading the data.
+
+     Args:
+         * mypath: string containing the path to the *Stata* file.
+
+     Returns:
+         * myvarlist: list of strings containing the names of the columns.
+
+     """
+
+    with pd.read_stata(mypath,iterator=True) as reader:
+        myvarlist = list(reader.variable_labels())
+    return myvarlist
+
+
+def read_stata_cached(mypath,mycolumns,mycachedir,mychunksize=100000,mymemmap=True):
+    """ Reads columns of a *Stata* file through a memory-mapped columnar cache.
+
+     The cache lives in a subdirectory of *mycachedir* named after the hash of the source
+     file. Columns that are not cached yet are converted from the *Stata* file, reading
+     only those columns and *mychunksize* observations at a time. When a new version of
+     the file is cached, the caches of the previous versions are removed.
+
+     Args:
+         * mypath: string containing the path to the *Stata* file.
+         * mycolumns: list of strings containing the names of the columns needed.
+         * mycachedir: string containing the directory where the caches are kept.
+         * mychunksize (optional): number of observations converted at a time.
+         * mymemmap (optional): if True, the columns are memory-mapped. Every memory map
+           keeps a file descriptor open, so when many columns are read at once (e.g. the
+           replicate weights) pass False to load them into memory instead.
+
+     Returns:
+         * mycolumns_dict: dictionary of arrays, one per column, read-only memory-mapped
+           if *mymemmap*.
+
+     """
+
+    myhash = hash_file(mypath)
+    myhashdir = os.path.join(mycachedir,myhash)
+    manifest_path = os.path.join(myhashdir,"manifest.json")
+    if os.path.exists(manifest_path):
+        with open(manifest_path) as in_file:
+            mymanifest = json.load(in_file)
+    else:
+        mymanifest = {'nobs':0,'columns':{}}
+        if os.path.isdir(mycachedir):
+            for dir_iterate in os.listdir(mycachedir):
+                shutil.rmtree(os.path.join(mycachedir,dir_iterate),ignore_errors=True)
+    missing = [column for column in mycolumns if column not in mymanifest['columns']]
+    if missing:
+        write_columns_cache(read_stata_chunks(mypath,missing,mychunksize),myhashdir,mymanifest)
+    mycolumns_dict = {}
+    for column_iterate in mycolumns:
+        column_entry = mymanifest['columns'][column_iterate]
+        column_path = os.path.join(myhashdir,column_entry['file'])
+        if mymemmap:
+            mycolumns_dict[column_iterate] = np.memmap(column_path,dtype=column_entry['dtype'],
+                                                       mode='r',shape=(mymanifest['nobs'],))
+        else:
+            mycolumns_dict[column_iterate] = np.fromfile(column_path,dtype=column_entry['dtype'])
+    return mycolumns_dict
+
+
+def iterate_chunks(mycolumns_dict,mychunksize):
+    """ Splits a dictionary of columns into consecutive chunks of observations.
+
+     Args:
+         * mycolumns_dict: dictionary of arrays with the same length.
+         * mychunksize: number of observations in each chunk.
+
+     Returns:
+         * mychunks: generator of dictionaries with the same keys, containing views of
+           *mychunksize* observations of each column.
+
+     """
+
+    nobs = len(next(iter(mycolumns_dict.values())))
+    for start in range(0,nobs,mychunksize):
+        yield {column:values[start:start+mychunksize] for column,values in mycolumns_dict.items()}
+
+
+def generate_buffer(myvalues):
+    """ Converts an array to a contiguous array that can be written as a raw buffer.
+
+     Object arrays (e.g. strings) are converted to fixed-width unicode.
+
+     Args:
+         * myvalues: array-like.
+
+     Returns:
+         * mybuffer: contiguous array without Python objects.
+
+     """
+
+    mybuffer = np.ascontiguousarray(myvalues)
+    if mybuffer.dtype.kind == 'O':
+        mybuffer = mybuffer.astype(str)
+    return mybuffer
+
+
+def generate_label(mylabel):
+    """ Converts a column or index label to a value that can be stored in JSON. """
+
+    if isinstance(mylabel,np.generic):
+        return mylabel.item()
+    return mylabel
+
+
+def generate_sorted_view(mybase,myorder,myderived):
+    """ Describes a sorted copy of a data frame without storing the copy.
+
+     Args:
+         * mybase: string containing the name of the entry with the data frame.
+         * myorder: array containing the permutation that sorts the data frame.
+         * myderived: dictionary of arrays containing the per-row columns to add to the
+           sorted data frame, in the sorted order.
+
+     Returns:
+         * myview: dictionary to be passed as an entry to *write_artifact*. The
+           permutation is stored as int32.
+
+     """
+
+    myview = {'view_of':mybase,
+              'order':np.asarray(myorder,dtype=np.int32),
+              'columns':myderived}
+    return myview
+
+
+def write_artifact(mypath,myentries):
+    """ Writes named entries to an artifact file.
+
+     The entries can be arrays, Data Frames, Series, scalars or sorted views of another
+     entry (see *generate_sorted_view*). The index of Data Frames can have several levels.
+     Data Frames (and Series) with at most
+     *ARTIFACT_RECORDS_MAX_ROWS* rows are stored as a single record array, larger ones
+     column by column.
+
+     Args:
+         * mypath: string containing the path to the artifact.
+         * myentries: dictionary with the entries to write.
+
+     """
+
+    header = {}
+    buffers = []
+    offset = 0
+
+    def add_buffer(myvalues):
+        nonlocal offset
+        mybuffer = generate_buffer(myvalues)
+        offset = -(-offset//ARTIFACT_ALIGNMENT)*ARTIFACT_ALIGNMENT
+        buffer_entry = {'offset':offset,
+                        'dtype':np.lib.format.dtype_to_descr(mybuffer.dtype),
+                        'shape':list(mybuffer.shape)}
+        buffers.append((offset,mybuffer))
+        offset += mybuffer.nbytes
+        return buffer_entry
+
+    for name,value in myentries.items():
+        if isinstance(value,(pd.DataFrame,pd.Series)):
+            is_series = isinstance(value,pd.Series)
+            myframe = value.to_frame() if is_series else value
+            # one array per level of the index, so that a MultiIndex is kept as well
+            myindex = [myframe.index.get_level_values(i) for i in range(myframe.index.nlevels)]
+            table_entry = {'series':is_series,
+                           'columns':[generate_label(label) for label in myframe.columns],
+                           'index_names':[generate_label(level) for level in myframe.index.names]}
+            if len(myframe) <= ARTIFACT_RECORDS_MAX_ROWS:
+                myrecords = np.rec.fromarrays(
+                        [generate_buffer(level) for level in myindex]
+                        + [generate_buffer(myframe.iloc[:,i]) for i in range(myframe.shape[1])],
+                        names=[f"index{i}" for i in range(len(myindex))]
+                              + [f"f{i}" for i in range(myframe.shape[1])])
+                header[name] = dict(kind='records',buffer=add_buffer(myrecords),**table_entry)
+            else:
+                header[name] = dict(kind='columns',index=[add_buffer(level) for level in myindex],
+                                    buffers=[add_buffer(myframe.iloc[:,i])
+                                             for i in range(myframe.shape[1])],
+                                    **table_entry)
+        elif isinstance(value,dict) and 'view_of' in value:
+            header[name] = {'kind':'view','view_of':value['view_of'],
+                            'order':add_buffer(value['order']),
+                            'columns':list(value['columns']),
+                            'buffers':[add_buffer(column) for column in value['columns'].values()]}
+        elif isinstance(value,np.ndarray):
+            header[name] = {'kind':'array','buffer':add_buffer(value)}
+        else:
+            header[name] = {'kind':'scalar','value':generate_label(value)}
+
+    header_bytes = json.dumps(header).encode()
+    data_start = len(ARTIFACT_MAGIC) + 8 + len(header_bytes)
+    data_start = -(-data_start//ARTIFACT_ALIGNMENT)*ARTIFACT_ALIGNMENT
+    with open(mypath+".tmp","wb") as out_file:
+        out_file.write(ARTIFACT_MAGIC)
+        out_file.write(len(header_bytes).to_bytes(8,'little'))
+        out_file.write(header_bytes)
+        for buffer_offset,mybuffer in buffers:
+            out_file.seek(data_start+buffer_offset)
+            out_file.write(mybuffer.tobytes())
+    os.replace(mypath+".tmp",mypath)
+
+
+def read_artifact_header(mypath):
+    """ Reads the description of the entries of an artifact, without loading them.
+
+     Args:
+         * mypath: string containing the path to the artifact.
+
+     Returns:
+         * header: dictionary with the kind and layout of each entry.
+         * data_start: position in the file where the buffers start.
+
+     """
+
+    with open(mypath,"rb") as in_file:
+        if in_file.read(len(ARTIFACT_MAGIC)) != ARTIFACT_MAGIC:
+            raise ValueError(f"{mypath} is not an artifact.")
+        header_length = int.from_bytes(in_file.read(8),'little')
+        header = json.loads(in_file.read(header_length))
+    data_start = len(ARTIFACT_MAGIC) + 8 + header_length
+    data_start = -(-data_start//ARTIFACT_ALIGNMENT)*ARTIFACT_ALIGNMENT
+    return header, data_start
+
+
+def read_buffer(mypath,mybuffer,data_start):
+    """ Memory-maps one buffer of an artifact as a read-only array. """
+
+    mydtype = np.lib.format.descr_to_dtype(mybuffer['dtype'])
+    shape = tuple(mybuffer['shape'])
+    if np.prod(shape) == 0:
+        return np.empty(shape,dtype=mydtype)
+    return np.memmap(mypath,dtype=mydtype,mode='r',offset=data_start+mybuffer['offset'],
+                     shape=shape)
+
+
+def read_artifact(mypath,mykeys=None):
+    """ Reads entries of an artifact.
+
+     Only the requested entries are loaded. Arrays are returned as read-only memory-mapped
+     arrays, so their data is read from disk only when it is used. Sorted views are
+     rebuilt from the data frame they refer to.
+
+     Args:
+         * mypath: string containing the path to the artifact.
+         * mykeys (optional): list of strings containing the names of the entries needed.
+           By default all the entries are read.
+
+     Returns:
+         * myentries: dictionary with the requested entries.
+
+     """
+
+    header, data_start = read_artifact_header(mypath)
+    if mykeys is None:
+        mykeys = list(header)
+    myentries = {}
+    for name in mykeys:
+        entry = header[name]
+        if entry['kind'] == 'scalar':
+            myentries[name] = entry['value']
+        elif entry['kind'] == 'array':
+            myentries[name] = read_buffer(mypath,entry['buffer'],data_start)
+        elif entry['kind'] == 'view':
+            if entry['view_of'] not in myentries:
+                myentries.update(read_artifact(mypath,[entry['view_of']]))
+            myframe = myentries[entry['view_of']].take(read_buffer(mypath,entry['order'],
+                                                                   data_start))
+            for column,mybuffer in zip(entry['columns'],entry['buffers']):
+                myframe[column] = read_buffer(mypath,mybuffer,data_start)
+            myentries[name] = myframe
+        else:
+            if entry['kind'] == 'records':
+                myrecords = read_buffer(mypath,entry['buffer'],data_start)
+                myindex = [myrecords[f"index{i}"] for i in range(len(entry['index_names']))]
+                mycolumns = [myrecords[f"f{i}"] for i in range(len(entry['columns']))]
+            else:
+                myindex = [read_buffer(mypath,mybuffer,data_start) for mybuffer in entry['index']]
+                mycolumns = [read_buffer(mypath,mybuffer,data_start)
+                             for mybuffer in entry['buffers']]
+            if len(myindex) == 1:
+                myindex = pd.Index(myindex[0],name=entry['index_names'][0])
+            else:
+                myindex = pd.MultiIndex.from_arrays(myindex,names=entry['index_names'])
+            myframe = pd.DataFrame(dict(enumerate(mycolumns)),index=myindex)
+            myframe.columns = entry['columns']
+            myentries[name] = myframe.iloc[:,0] if entry['series'] else myframe
+    return {name:myentries[name] for name in mykeys}
@@ -2,13 +2,44 @@
 
 This module called *test_myfunctions.py* contains several tests for the functions contained
 in the module *myfunctions.py*. First, it contains two setup functions called by the
-tests and, second, it runs four different tests:
+tests and, second, it runs the following tests:
      * setup_mytest: generates the artifical dataset sfc_test that is used in the tests.
      * expected_ouptut: in creates a dataframe containing the results that should come out of the functions.
+     * test_generate_sort_index: tests the function generate_sort_index, including the reuse and the invalidation of the cache.
      * test_generate_bins: tests the function generate_bins.
+     * test_generate_bins_batch: tests the function generate_bins_batch.
      * test_generate_densities: tests the function generate_densities.
+     * test_generate_ecdf: tests the function generate_ecdf, including the sort permutation and ties.
+     * test_generate_histogram: tests the function generate_histogram, including the trimming.
+     * test_generate_linear_binning: tests the function generate_linear_binning.
+     * test_generate_kde: tests the function generate_kde against the direct sum over the observations, by group.
+     * test_generate_weighted_quantiles: tests the function generate_weighted_quantiles.
+     * test_generate_percentile_ranks: tests the function generate_percentile_ranks.
      * test_generate_gini: tests the function generate_gini. Checks both the Gini Coefficient and the Lorenz Curve.
+     * test_generate_gini_batch: tests the function generate_gini_batch with several variables at once, and on a grid.
+     * test_generate_concentration: tests the function generate_concentration, including tied ranking values.
+     * test_generate_cumulative_shares: tests the function generate_cumulative_shares, including one column of weights per variable.
+     * test_generate_top_shares: tests the function generate_top_shares, including the Pareto tail and the cumulative shares of generate_gini_batch.
+     * test_generate_inequality_indices: tests the function generate_inequality_indices, including non-positive values.
+     * test_generate_group_gini: tests the function generate_group_gini against generate_gini_batch on each group.
+     * test_generate_inequality_decomposition: tests the function generate_inequality_decomposition with overlapping and non-overlapping groups.
+     * test_generate_source_decomposition: tests the function generate_source_decomposition against generate_gini_batch, including tied totals.
+     * test_generate_tie_groups: tests the function generate_tie_groups.
      * test_generate_averages: tests the function generate_averages.
+     * test_generate_group_aggregates: tests the function generate_group_aggregates by group, including the totals.
+     * test_generate_joint_distribution: tests the function generate_joint_distribution, including empty cells.
+     * test_generate_bin_averages: tests the functions generate_prefix_index and generate_bin_averages.
+     * test_generate_ratios: tests the function generate_ratios.
+     * test_generate_partition_statistics: tests the function generate_partition_statistics against the single kernels.
+     * test_generate_parallel_map: tests the function generate_parallel_map.
+     * test_generate_rubin: tests the function generate_rubin with and without within-implicate variances.
+     * test_generate_unsorted: tests the function generate_unsorted.
+     * test_generate_replicate_weights: tests the function generate_replicate_weights with one row per household.
+     * test_generate_replicate_averages: tests the function generate_replicate_averages against generate_averages.
+     * test_generate_gini_replicates: tests the function generate_gini_replicates against generate_gini_batch.
+     * test_generate_replicate_variance: tests the function generate_replicate_variance for tables and scalars.
+     * test_generate_lorenz_grid: tests the function generate_lorenz_grid.
+     * test_generate_gini_bootstrap: tests the function generate_gini_bootstrap, including the reproducibility of the draws and the draws per household.
 
 """
 import sys
@@ -17,6 +48,23 @@ import pandas as pd
 import numpy as np
 from pandas.testing import assert_frame_equal, assert_series_equal
 from src.functions.myfunctions import generate_bins, generate_densities,generate_gini,generate_averages
+from src.functions.myfunctions import generate_bins_batch, generate_gini_batch, generate_ecdf
+from src.functions.myfunctions import generate_group_aggregates, generate_prefix_index
+from src.functions.myfunctions import generate_bin_averages, generate_sort_index
+from src.functions.myfunctions import generate_ratios, generate_partition_statistics
+from src.functions.myfunctions import generate_parallel_map, generate_rubin
+from src.functions.myfunctions import generate_unsorted, generate_replicate_averages
+from src.functions.myfunctions import generate_tie_groups
+from src.functions.myfunctions import generate_gini_replicates, generate_replicate_variance
+from src.functions.myfunctions import generate_lorenz_grid, generate_gini_bootstrap
+from src.functions.myfunctions import generate_weighted_quantiles, generate_percentile_ranks
+from src.functions.myfunctions import generate_cumulative_shares, generate_top_shares
+from src.functions.myfunctions import generate_inequality_indices, generate_group_gini
+from src.functions.myfunctions import generate_inequality_decomposition
+from src.functions.myfunctions import generate_source_decomposition, generate_concentration
+from src.functions.myfunctions import generate_joint_distribution, generate_histogram
+from src.functions.myfunctions import generate_linear_binning, generate_kde
+from src.functions.myfunctions import generate_replicate_weights
 
 def setup_mytest():
     sfc_test = pd.DataFrame(data=[[1,2,3,4,5],
@@ -49,12 +97,35 @@ def expected_output():
     expected_out['average_total']['hh_weights'] = float(expected_out['average_weights'])
     return expected_out
 
+def test_generate_sort_index():
+    sfc_test = setup_mytest()
+    sfc_test['hh_age'] = [53,27,78,36,61]
+    sort_cache = {}
+    actual_index = generate_sort_index(sfc_test,'hh_age',sort_cache)
+    np.testing.assert_array_equal(actual_index,[1,3,0,4,2])
+    assert generate_sort_index(sfc_test,'hh_age',sort_cache) is actual_index
+    ginico_actual, _ = generate_gini_batch(sfc_test['hh_age'],sfc_test['hh_weights'],actual_index)
+    np.testing.assert_array_almost_equal(ginico_actual,
+                                         generate_gini_batch(sfc_test['hh_age'],sfc_test['hh_weights'])[0])
+    # changing the column invalidates the cached permutation
+    sfc_test.loc[0,'hh_age'] = 20
+    np.testing.assert_array_equal(generate_sort_index(sfc_test,'hh_age',sort_cache),[0,1,3,4,2])
+
 def test_generate_bins():
     sfc_test = setup_mytest()
     expected_out = expected_output()
     endpoints_test = [35,45,55,65]
     actual_output = generate_bins(endpoints_test,sfc_test['hh_age'])
     np.testing.assert_array_almost_equal(actual_output,expected_out['age_bin'])
+
+def test_generate_bins_batch():
+    sfc_test = setup_mytest()
+    expected_out = expected_output()
+    actual_output = generate_bins_batch([[35,45,55,65],[50],[100]],sfc_test['hh_age'])
+    np.testing.assert_array_equal(actual_output[0],expected_out['age_bin'])
+    np.testing.assert_array_equal(actual_output[1],[1,1,2,2,2])
+    np.testing.assert_array_equal(actual_output[2],[1,1,1,1,1])
+    assert actual_output.dtype == np.uint8
     
 def test_generate_densities():
     sfc_test = setup_mytest()
@@ -62,6 +133,19 @@ def test_generate_densities():
     actual_output_pdf, actual_output_cdf = generate_densities(sfc_test['hh_weights'],sfc_test['net_worth'])
     np.testing.assert_array_almost_equal(actual_output_pdf,expected_out['pdf'])
     np.testing.assert_array_almost_equal(actual_output_cdf,expected_out['cdf'])
+
+def test_generate_ecdf():
+    sfc_test = setup_mytest()
+    expected_out = expected_output()
+    actual_output_pdf, actual_output_cdf, actual_index = generate_ecdf(sfc_test['hh_weights'],
+                                                                       sfc_test['hh_age'][::-1])
+    np.testing.assert_array_almost_equal(actual_output_pdf,expected_out['pdf'])
+    np.testing.assert_array_almost_equal(actual_output_cdf,expected_out['cdf'])
+    np.testing.assert_array_equal(actual_index,[4,3,2,1,0])
+    # ties keep their original order, whatever their weight
+    actual_output_pdf, _, actual_index = generate_ecdf([3,1,1],[2,1,2])
+    np.testing.assert_array_equal(actual_index,[1,0,2])
+    np.testing.assert_array_almost_equal(actual_output_pdf,[0.2,0.6,0.2])
     
 def test_generate_gini():
     sfc_test = setup_mytest()
@@ -71,6 +155,20 @@ def test_generate_gini():
                                                  mynobs)
     np.testing.assert_array_almost_equal(lorenz_actual,expected_out['lorenz'])
     np.testing.assert_array_almost_equal(ginico_actual,expected_out['ginico'])
+
+def test_generate_gini_batch():
+    sfc_test = setup_mytest()
+    expected_out = expected_output()
+    ginico_actual, lorenz_actual = generate_gini_batch(sfc_test[['net_worth','hh_weights']],
+                                                       sfc_test['hh_weights'])
+    np.testing.assert_array_almost_equal(ginico_actual,[expected_out['ginico'],0])
+    np.testing.assert_array_almost_equal(lorenz_actual[:,0],expected_out['lorenz'])
+    np.testing.assert_array_almost_equal(lorenz_actual[:,1],np.linspace(0,1,6))
+    # on a grid of weighted population shares
+    ginico_grid, lorenz_grid = generate_gini_batch([1.0,2.0],[3.0,1.0],mygrid=[0,0.375,0.75,1])
+    ginico_actual, _ = generate_gini_batch([1.0,2.0],[3.0,1.0])
+    np.testing.assert_almost_equal(ginico_grid,ginico_actual)
+    np.testing.assert_array_almost_equal(lorenz_grid,[0,0.3,0.6,1])
     
 def test_generate_averages():
     sfc_test = setup_mytest()
@@ -78,6 +176,356 @@ def test_generate_averages():
     actual_average = generate_averages(sfc_test,'hh_weights')
     assert_frame_equal(actual_average, expected_out['average_total'])
 
+def test_generate_group_aggregates():
+    sfc_test = setup_mytest()
+    sfc_test['hh_weights'] = [1,3,1,1,2]
+    sfc_test['age_bin'] = [1,1,2,2,2]
+    actual_average, actual_sums, actual_counts, actual_weights = generate_group_aggregates(
+            sfc_test,'hh_weights','age_bin',mytotals=True)
+    np.testing.assert_array_almost_equal(actual_average['net_worth'],[7/4,17/4])
+    np.testing.assert_array_almost_equal(actual_average['age_bin'],[1,2])
+    np.testing.assert_array_almost_equal(actual_sums['hh_age'],[135,270])
+    np.testing.assert_array_equal(actual_counts,[2,3])
+    np.testing.assert_array_almost_equal(actual_weights,[4,4])
+    assert list(actual_average.index) == [1,2]
+
+def test_generate_bin_averages():
+    sfc_test = setup_mytest()
+    sfc_test['hh_weights'] = [1,3,1,1,2]
+    sfc_test['age_bin'] = [1,1,2,2,2]
+    expected_average = generate_averages(sfc_test,'hh_weights','age_bin')
+    myprefixindex = generate_prefix_index(sfc_test,'hh_weights','hh_age')
+    actual_average = generate_bin_averages(myprefixindex,[50])
+    assert_frame_equal(actual_average,expected_average,check_index_type=False)
+    actual_average = generate_bin_averages(myprefixindex,[35,45,55,65])
+    np.testing.assert_array_almost_equal(actual_average['net_worth'],[1,2,3,4,5])
+
+
+def test_generate_ratios():
+    sfc_test = setup_mytest()
+    actual_output = generate_ratios(sfc_test,{'income_total':['net_worth'],'hh_age':['hh_weights']})
+    np.testing.assert_array_almost_equal(actual_output['net_worth'],[100,100,100,100,100])
+    np.testing.assert_array_almost_equal(actual_output['hh_weights'],100/sfc_test['hh_age'])
+    np.testing.assert_array_almost_equal(sfc_test['net_worth'],[1,2,3,4,5])
+
+def test_generate_partition_statistics():
+    sfc_test = setup_mytest()
+    sfc_test['hh_weights'] = [1,3,1,1,2]
+    actual_output = generate_partition_statistics(sfc_test,'hh_weights',
+                                                  {'age':('hh_age',[50],False),
+                                                   'halves':('net_worth',[0.5],True)},
+                                                  ['net_worth'])
+    sfc_test['age_bin'] = [1,1,2,2,2]
+    expected_average = generate_averages(sfc_test,'hh_weights','age_bin').drop(columns='age_bin')
+    assert_frame_equal(actual_output['age'],expected_average,check_index_type=False)
+    assert_frame_equal(actual_output['halves'],expected_average,check_index_type=False)
+    assert_frame_equal(actual_output['average_total'],
+                       generate_averages(sfc_test.drop(columns='age_bin'),'hh_weights'))
+    np.testing.assert_almost_equal(actual_output['gini_net_worth'],
+                                   generate_gini_batch(sfc_test['net_worth'],sfc_test['hh_weights'])[0])
+
+def test_generate_parallel_map():
+    actual_output = generate_parallel_map(np.sum,[[1,2],[3,4],[5]],mymaxworkers=2)
+    assert actual_output == [3,7,5]
+
+def test_generate_rubin():
+    actual_estimate, actual_variance = generate_rubin([1.0,2.0,3.0])
+    np.testing.assert_almost_equal(actual_estimate,2)
+    np.testing.assert_almost_equal(actual_variance,4/3)
+    sfc_test = setup_mytest()
+    actual_estimate, actual_variance = generate_rubin([sfc_test,sfc_test+2],[sfc_test,sfc_test])
+    assert_frame_equal(actual_estimate,sfc_test+1.0)
+    assert_frame_equal(actual_variance,sfc_test+3.0)
+
+def test_generate_unsorted():
+    np.testing.assert_array_equal(generate_unsorted(np.array([2,0,1]),np.array([1,2,3])),[2,3,1])
+
+def test_generate_replicate_averages():
+    sfc_test = setup_mytest()
+    myreplicates = np.array([[1,1,1,1,1],[1,3,1,1,2]]).T
+    actual_output = generate_replicate_averages(sfc_test,myreplicates,[1,1,2,2,2])
+    assert list(actual_output.index) == [(1,1),(1,2),(2,1),(2,2)]
+    sfc_test['hh_weights'] = [1,3,1,1,2]
+    sfc_test['age_bin'] = [1,1,2,2,2]
+    expected_average = generate_averages(sfc_test,'hh_weights','age_bin')
+    np.testing.assert_array_almost_equal(actual_output.loc[2,['net_worth','hh_age']],
+                                         expected_average[['net_worth','hh_age']])
+    np.testing.assert_array_almost_equal(actual_output.loc[1,'net_worth'],[1.5,4])
+
+def test_generate_gini_replicates():
+    sfc_test = setup_mytest()
+    myreplicates = np.array([[1,1,1,1,1],[1,3,1,1,2],[2,2,2,2,2]]).T
+    actual_output = generate_gini_replicates(sfc_test['net_worth'],myreplicates,myblocksize=2)
+    expected_output = [generate_gini_batch(sfc_test['net_worth'],myreplicates[:,r])[0]
+                       for r in range(3)]
+    np.testing.assert_array_almost_equal(actual_output,expected_output)
+
+def test_generate_replicate_variance():
+    np.testing.assert_almost_equal(generate_replicate_variance(1.0,[0.0,2.0,1.0,1.0]),0.5)
+    myestimate = pd.DataFrame({'net_worth':[1.0,2.0]},index=[1,2])
+    myreplicates = pd.DataFrame({'net_worth':[0.0,2.0,2.0,4.0]},
+                                index=pd.MultiIndex.from_product([[1,2],[1,2]],
+                                                                 names=['replicate','group']))
+    actual_output = generate_replicate_variance(myestimate,myreplicates)
+    assert_frame_equal(actual_output,pd.DataFrame({'net_worth':[1.0,2.0]},index=[1,2]))
+
+def test_generate_lorenz_grid():
+    actual_output = generate_lorenz_grid([0.5,1.0],[0.25,1.0],[0.0,0.25,0.5,0.75,1.0])
+    np.testing.assert_array_almost_equal(actual_output,[0.0,0.125,0.25,0.625,1.0])
+    actual_output = generate_lorenz_grid(np.array([[0.5,0.5],[1.0,1.0]]),
+                                         np.array([[0.25,0.5],[1.0,1.0]]),[0.5])
+    np.testing.assert_array_almost_equal(actual_output,[[0.25,0.5]])
+
+def test_generate_gini_bootstrap():
+    sfc_test = setup_mytest()
+    mygrid = np.linspace(0,1,11)
+    myvariables = np.array(sfc_test[['net_worth','hh_age']],dtype=float)
+    gini_interval, lorenz_interval = generate_gini_bootstrap(myvariables,np.ones(5),200,1,mygrid,
+                                                             mymaxworkers=2)
+    assert gini_interval.shape == (2,2) and lorenz_interval.shape == (2,11,2)
+    assert np.all(gini_interval[0] <= gini_interval[1])
+    assert np.all(lorenz_interval[0] <= lorenz_interval[1])
+    np.testing.assert_array_almost_equal(lorenz_interval[:,[0,-1]],[[[0,0],[1,1]],[[0,0],[1,1]]])
+    # the draws only depend on the seed, not on the number of processes
+    gini_serial, lorenz_serial = generate_gini_bootstrap(myvariables[:,0],np.ones(5),200,1,mygrid,
+                                                         mymethod='bayesian',mymaxworkers=1)
+    np.testing.assert_array_almost_equal(gini_serial,gini_interval[:,0])
+    np.testing.assert_array_almost_equal(lorenz_serial,lorenz_interval[:,:,0])
+    gini_multinomial, _ = generate_gini_bootstrap(myvariables[:,0],np.ones(5),50,1,mygrid,
+                                                  mymethod='multinomial',mymaxworkers=1)
+    assert gini_multinomial[0] <= gini_multinomial[1]
+    # five rows per household with one draw per household give the same interval as one row
+    gini_clustered, lorenz_clustered = generate_gini_bootstrap(np.repeat(myvariables[:,0],5),
+                                                               np.ones(25),200,1,mygrid,
+                                                               mymaxworkers=1,
+                                                               mycodes=np.repeat(np.arange(5),5))
+    np.testing.assert_array_almost_equal(gini_clustered,gini_serial)
+    np.testing.assert_array_almost_equal(lorenz_clustered,lorenz_serial)
+    gini_rows, _ = generate_gini_bootstrap(np.repeat(myvariables[:,0],5),np.ones(25),200,1,
+                                           mygrid,mymaxworkers=1)
+    assert gini_rows[1] - gini_rows[0] < gini_clustered[1] - gini_clustered[0]
+
+def test_generate_weighted_quantiles():
+    mysorted = np.array([1.0,2.0,3.0,4.0])
+    mycdf = np.array([0.1,0.5,0.9,1.0-1e-16])
+    actual_output = generate_weighted_quantiles(mysorted,mycdf,[0.05,0.1,0.5,0.51,0.99,1.0])
+    np.testing.assert_array_equal(actual_output,[1,1,2,3,4,4])
+    actual_output = generate_weighted_quantiles(np.column_stack([mysorted,10*mysorted]),
+                                                np.column_stack([mycdf,[0.25,0.5,0.75,1.0]]),
+                                                [0.3,0.6])
+    np.testing.assert_array_equal(actual_output,[[2,20],[3,30]])
+
+def test_generate_percentile_ranks():
+    mysorted = np.array([1.0,2.0,2.0,4.0])
+    mycdf = np.array([0.1,0.5,0.9,1.0])
+    actual_output = generate_percentile_ranks(mysorted,mycdf,[0.0,1.0,2.0,3.0,5.0])
+    np.testing.assert_array_almost_equal(actual_output,[0.0,0.1,0.9,0.9,1.0])
+
+def test_generate_cumulative_shares():
+    actual_pci, actual_pxi = generate_cumulative_shares([3.0,1.0],[1.0,3.0])
+    np.testing.assert_array_almost_equal(actual_pci,[[0.75],[1.0]])
+    np.testing.assert_array_almost_equal(actual_pxi,[[0.5],[1.0]])
+    # one column of weights per variable
+    actual_pci, actual_pxi = generate_cumulative_shares([[3.0,3.0],[1.0,1.0]],[[1.0,3.0],[3.0,1.0]])
+    np.testing.assert_array_almost_equal(actual_pci,[[0.75,0.25],[1.0,1.0]])
+    np.testing.assert_array_almost_equal(actual_pxi,[[0.5,0.1],[1.0,1.0]])
+
+def test_generate_top_shares():
+    myvariable = np.arange(1.0,1001.0)
+    actual_output = generate_top_shares(np.column_stack([myvariable,myvariable[::-1]]),
+                                        np.ones(1000),[0.1,0.05],myminobs=0)
+    np.testing.assert_array_almost_equal(actual_output,[[95050/500500]*2,[48775/500500]*2])
+    # the top 1% holds fewer than 200 observations: Pareto tail anchored at the top 20%
+    actual_output = generate_top_shares(myvariable,np.ones(1000),[0.2,0.01],myminobs=200)
+    s0 = np.sum(myvariable[800:])/np.sum(myvariable)
+    np.testing.assert_array_almost_equal(actual_output,
+                                         [s0,s0*(0.01/0.2)**(np.log(1/s0)/np.log(5))])
+    # the cumulative shares of the Gini pass give the same top shares
+    _, _, mycumulativeshares = generate_gini_batch(myvariable,np.ones(1000),mycumulative=True)
+    np.testing.assert_array_almost_equal(generate_top_shares(myvariable,np.ones(1000),[0.2,0.01],
+                                                             myminobs=200,
+                                                             mycumulativeshares=mycumulativeshares),
+                                         actual_output)
+
+def test_generate_inequality_indices():
+    mydataset = pd.DataFrame({'income':[1.0,2.0,3.0,4.0],'wealth':[-1.0,0.0,2.0,6.0],
+                              'weight':[1.0,1.0,2.0,1.0]})
+    actual_output = generate_inequality_indices(mydataset,'weight',['income','wealth'],
+                                                mysortcache={})
+    income = np.array([1.0,2.0,3.0,3.0,4.0])
+    relative = income/income.mean()
+    np.testing.assert_almost_equal(actual_output.loc['theil','income'],np.mean(relative*np.log(relative)))
+    np.testing.assert_almost_equal(actual_output.loc['mld','income'],-np.mean(np.log(relative)))
+    np.testing.assert_almost_equal(actual_output.loc['atkinson_1','income'],
+                                   1 - np.exp(np.mean(np.log(income)))/income.mean())
+    np.testing.assert_almost_equal(actual_output.loc['ge_2','income'],
+                                   actual_output.loc['cv','income']**2/2)
+    np.testing.assert_almost_equal(actual_output.loc['p90_p10','income'],4)
+    # non-positive wealth: left out of the log-based indices, reported as a share
+    np.testing.assert_almost_equal(actual_output.loc['share_nonpositive','wealth'],0.4)
+    np.testing.assert_almost_equal(actual_output.loc['mean','wealth'],1.8)
+    np.testing.assert_almost_equal(actual_output.loc['ge_2','wealth'],0.16)
+    assert np.isnan(actual_output.loc['p90_p10','wealth'])
+
+def test_generate_group_gini():
+    rng = np.random.default_rng(0)
+    mydataset = pd.DataFrame({'net_worth':rng.lognormal(size=60),'weight':rng.uniform(1,3,60),
+                              'group':rng.integers(1,4,60).astype(float)})
+    mydataset.loc[0,'group'] = np.nan
+    mygrid = np.linspace(0,1,11)
+    actual_ginis, actual_lorenz = generate_group_gini(mydataset,'net_worth','weight','group',mygrid)
+    assert list(actual_ginis.index) == [1.0,2.0,3.0]
+    for group, group_iterate in mydataset.dropna().groupby('group'):
+        expected_gini, _ = generate_gini_batch(group_iterate['net_worth'],
+                                               group_iterate['weight'])
+        expected_pci, expected_pxi = generate_cumulative_shares(group_iterate['net_worth'],
+                                                                group_iterate['weight'])
+        np.testing.assert_almost_equal(actual_ginis.loc[group,'gini'],expected_gini)
+        assert actual_ginis.loc[group,'nobs'] == len(group_iterate)
+        np.testing.assert_array_almost_equal(actual_lorenz.loc[group,'lorenz'],
+                                             generate_lorenz_grid(expected_pci[:,0],
+                                                                  expected_pxi[:,0],mygrid))
+
+def test_generate_inequality_decomposition():
+    mydataset = pd.DataFrame({'income':[1.0,2.0,10.0,11.0,-1.0],'weight':[1.0,2.0,1.0,1.0,1.0],
+                              'group':[1,1,2,2,1]})
+    # groups that do not overlap: no overlap term
+    actual_output = generate_inequality_decomposition(mydataset.iloc[:4],'income','weight','group')
+    expected_gini, _ = generate_gini_batch(mydataset['income'].iloc[:4],mydataset['weight'].iloc[:4])
+    np.testing.assert_almost_equal(actual_output.loc['gini','total'],expected_gini)
+    np.testing.assert_almost_equal(actual_output.loc['gini','overlap'],0)
+    # the Theil index only uses the positive observations, and the parts add up
+    actual_output = generate_inequality_decomposition(mydataset,'income','weight','group')
+    expected_theil = generate_inequality_indices(mydataset,'weight',['income']).loc['theil','income']
+    np.testing.assert_almost_equal(actual_output.loc['theil','total'],expected_theil)
+    np.testing.assert_almost_equal(actual_output.loc['theil',['within','between']].sum(),expected_theil)
+    expected_gini, _ = generate_gini_batch(mydataset['income'],mydataset['weight'])
+    np.testing.assert_almost_equal(actual_output.loc['gini','total'],expected_gini)
+    assert actual_output.loc['gini','overlap'] > 0
+
+def test_generate_source_decomposition():
+    rng = np.random.default_rng(0)
+    mydataset = pd.DataFrame({'wage':rng.lognormal(size=100),
+                              'capital':rng.lognormal(size=100)*(rng.random(100) < 0.3),
+                              'weight':rng.uniform(1,3,100)})
+    mydataset['income'] = mydataset['wage'] + mydataset['capital']
+    actual_output = generate_source_decomposition(mydataset,'income',['wage','capital'],'weight')
+    expected_ginis, _ = generate_gini_batch(mydataset[['income','wage','capital']],mydataset['weight'])
+    np.testing.assert_array_almost_equal(actual_output['gini'],expected_ginis[1:])
+    # concentration coefficients: the sources ranked by the total
+    income_index_sorted = np.argsort(mydataset['income'].to_numpy(),kind='stable')
+    expected_concentration, _ = generate_gini_batch(mydataset[['wage','capital']],mydataset['weight'],
+                                                    np.column_stack([income_index_sorted]*2))
+    np.testing.assert_array_almost_equal(actual_output['concentration'],expected_concentration)
+    np.testing.assert_almost_equal(np.sum(actual_output['share']*actual_output['concentration']),
+                                   expected_ginis[0])
+    np.testing.assert_almost_equal(actual_output['contribution'].sum(),1)
+    np.testing.assert_almost_equal(actual_output['marginal_effect'].sum(),0)
+    # tied totals with different source mixes: the order of the rows does not matter
+    mydataset['income'] = mydataset['income'].round()
+    mydataset['wage'] = mydataset['income'] - mydataset['capital']
+    actual_output = generate_source_decomposition(mydataset,'income',['wage','capital'],'weight')
+    shuffled_output = generate_source_decomposition(mydataset.iloc[rng.permutation(100)],'income',
+                                                    ['wage','capital'],'weight')
+    assert_frame_equal(shuffled_output,actual_output)
+    expected_gini, _ = generate_gini_batch(mydataset['income'],mydataset['weight'])
+    np.testing.assert_almost_equal(np.sum(actual_output['share']*actual_output['concentration']),
+                                   expected_gini)
+
+def test_generate_tie_groups():
+    np.testing.assert_array_equal(generate_tie_groups([1.0,1.0,2.0,3.0,3.0,3.0]),[0,0,1,2,2,2])
+
+def test_generate_concentration():
+    myranking = np.array([3.0,1.0,2.0,4.0])
+    myoutcomes = np.array([[1.0,4.0],[2.0,3.0],[3.0,2.0],[4.0,1.0]])
+    actual_index, actual_curve = generate_concentration(myranking,myoutcomes,np.ones(4))
+    # ranked by itself, the concentration index is the Gini Coefficient
+    expected_gini, _ = generate_gini_batch(myranking,np.ones(4))
+    np.testing.assert_almost_equal(generate_concentration(myranking,myranking,np.ones(4))[0],
+                                   expected_gini)
+    np.testing.assert_array_almost_equal(actual_curve[:,0],[0,0.2,0.5,0.6,1.0])
+    np.testing.assert_array_almost_equal(actual_curve[:,1],[0,0.3,0.5,0.9,1.0])
+    assert actual_index.shape == (2,) and actual_index[0] < expected_gini
+    actual_index_1d, actual_curve_1d = generate_concentration(myranking,myoutcomes[:,0],np.ones(4),
+                                                              np.argsort(myranking))
+    np.testing.assert_almost_equal(actual_index_1d,actual_index[0])
+    np.testing.assert_array_almost_equal(actual_curve_1d,actual_curve[:,0])
+    # tied ranking values: the outcomes of a group are added up, whatever the order of the rows
+    rng = np.random.default_rng(0)
+    myranking = rng.integers(0,10,200).astype(float)
+    myoutcomes = rng.lognormal(size=(200,2))
+    myweights = rng.uniform(1,3,200)
+    actual_index, actual_curve = generate_concentration(myranking,myoutcomes,myweights,
+                                                        mygrid=np.linspace(0,1,11))
+    mypermutation = rng.permutation(200)
+    shuffled_index, shuffled_curve = generate_concentration(myranking[mypermutation],
+                                                            myoutcomes[mypermutation],
+                                                            myweights[mypermutation],
+                                                            mygrid=np.linspace(0,1,11))
+    np.testing.assert_array_almost_equal(shuffled_index,actual_index)
+    np.testing.assert_array_almost_equal(shuffled_curve,actual_curve)
+    assert generate_concentration(myranking,myoutcomes,myweights)[1].shape == (11,2)
+    # same concentration coefficients as the source decomposition, which uses mid-ranks
+    mydataset = pd.DataFrame({'total':myranking,'a':myoutcomes[:,0],'b':myoutcomes[:,1],
+                              'weight':myweights})
+    expected_output = generate_source_decomposition(mydataset,'total',['a','b'],'weight')
+    np.testing.assert_array_almost_equal(actual_index,expected_output['concentration'])
+
+def test_generate_joint_distribution():
+    sfc_test = setup_mytest()
+    sfc_test['hh_weights'] = [1.0,3.0,1.0,1.0,2.0]
+    actual_shares, actual_means = generate_joint_distribution(sfc_test,'hh_weights',[1,1,2,2,2],
+                                                              [1,2,2,2,1],2,3)
+    np.testing.assert_array_almost_equal(actual_shares,[[1/8,3/8,0],[2/8,2/8,0]])
+    assert list(actual_means['row']) == [1,1,1,2,2,2]
+    assert list(actual_means['column']) == [1,2,3,1,2,3]
+    np.testing.assert_array_almost_equal(actual_means['hh_age'],
+                                         [sfc_test['hh_age'][0],sfc_test['hh_age'][1],np.nan,
+                                          sfc_test['hh_age'][4],sfc_test['hh_age'][2:4].mean(),np.nan])
+
+def test_generate_histogram():
+    sfc_test = setup_mytest()
+    myweights = np.array([1.0,3.0,1.0,1.0,2.0])
+    actual_counts, actual_edges = generate_histogram(sfc_test['net_worth'],myweights,2)
+    np.testing.assert_array_almost_equal(actual_counts,[4,4])
+    np.testing.assert_array_almost_equal(actual_edges,[1,3,5])
+    actual_counts, _ = generate_histogram(sfc_test['net_worth'],myweights,[0,2,4],
+                                          sfc_test['net_worth'] < 4)
+    np.testing.assert_array_almost_equal(actual_counts,[1,4])
+
+def test_generate_linear_binning():
+    actual_output = generate_linear_binning([0.25,1.0,2.0],[4.0,1.0,2.0],np.array([0.0,1.0,2.0]),
+                                            [0,1,1],2)
+    np.testing.assert_array_almost_equal(actual_output,[[3,1,0],[0,1,2]])
+
+def test_generate_kde():
+    rng = np.random.default_rng(0)
+    mydataset = pd.DataFrame({'income':rng.normal(size=300),'weight':rng.uniform(1,3,300),
+                              'group':rng.integers(1,3,300)})
+    actual_output = generate_kde(mydataset,'income','weight',mygridsize=2048,mybandwidth=0.3,
+                                 mygroup='group')
+    assert list(actual_output) == ['density','density_1','density_2']
+    mygrid = actual_output.index.to_numpy()
+    for column, mysample in [('density',mydataset),
+                             ('density_1',mydataset[mydataset['group'] == 1])]:
+        kernel = np.exp(-((mygrid[:,None] - mysample['income'].to_numpy())/0.3)**2/2)/np.sqrt(2*np.pi)/0.3
+        expected_density = kernel @ mysample['weight'].to_numpy()/mysample['weight'].sum()
+        np.testing.assert_allclose(actual_output[column],expected_density,atol=1e-3)
+    np.testing.assert_almost_equal(actual_output['density'].sum()*(mygrid[1] - mygrid[0]),1,decimal=3)
+    # default bandwidth and trimming
+    actual_output = generate_kde(mydataset,'income','weight',mykeep=mydataset['income'] < 1)
+    mygrid = actual_output.index.to_numpy()
+    np.testing.assert_almost_equal(actual_output['density'].sum()*(mygrid[1] - mygrid[0]),1,decimal=3)
+    assert actual_output['density'].iloc[-1] < 1e-2
+
+def test_generate_replicate_weights():
+    # the replicate weight file has one row per household, the dataset one per implicate
+    myids = np.repeat([7,3],5)
+    actual_output = generate_replicate_weights(myids,[3,7],[[1.0,2.0],[3.0,np.nan]],
+                                               [[2,0],[1,1]])
+    np.testing.assert_array_equal(actual_output,[[3.0,0.0]]*5 + [[2.0,0.0]]*5)
+    with pytest.raises(ValueError):
+        generate_replicate_weights([1,3],[3,7],[[1.0],[1.0]],[[1],[1]])
 
 
 if __name__ == '__main__':
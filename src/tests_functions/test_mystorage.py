@@ -0,0 +1,145 @@
+"""
+
+This module called *test_mystorage.py* contains tests for the functions contained
+in the module *mystorage.py*. It uses the artificial dataset generated by setup_mytest,
+written to a temporary *Stata* file:
+     * setup_mytest: generates the artifical dataset sfc_test that is used in the tests.
+     * test_read_stata_cached: tests the function read_stata_cached, including the reuse and the invalidation of the cache.
+     * test_read_stata_cached_many_columns: tests that read_stata_cached reads hundreds of columns without running out of file descriptors.
+     * test_read_stata_chunks: tests the functions read_stata_chunks and iterate_chunks.
+     * test_read_stata_varlist: tests the function read_stata_varlist.
+     * test_write_artifact: tests the functions write_artifact and read_artifact with every kind of entry and indexes with several levels.
+     * test_generate_sorted_view: tests that a sorted view is stored as a permutation and rebuilt on demand.
+
+"""
+import os
+import sys
+import resource
+import pytest
+import pandas as pd
+import numpy as np
+from pandas.testing import assert_frame_equal, assert_series_equal
+import src.functions.mystorage as mystorage
+from src.functions.mystorage import read_stata_cached, read_stata_chunks, iterate_chunks
+from src.functions.mystorage import read_stata_varlist
+from src.functions.mystorage import write_artifact, read_artifact, read_artifact_header
+from src.functions.mystorage import generate_sorted_view
+
+def setup_mytest():
+    sfc_test = pd.DataFrame(data=[[1,2,3,4,5],
+                             [1,2,3,4,5],
+                             [27,36,53,61,78],
+                             [1,1,1,1,1]])
+    sfc_test = sfc_test.T
+    sfc_test.columns = ['net_worth','income_total','hh_age','hh_weights']
+    sfc_test = sfc_test.astype(np.float64)
+    
+    return sfc_test
+
+def test_read_stata_cached(tmp_path):
+    sfc_test = setup_mytest()
+    stata_path = str(tmp_path / "sfc_test.dta")
+    cache_dir = str(tmp_path / "cache")
+    sfc_test.to_stata(stata_path,write_index=False)
+    actual_output = read_stata_cached(stata_path,['hh_age','net_worth'],cache_dir)
+    assert list(actual_output) == ['hh_age','net_worth']
+    assert isinstance(actual_output['hh_age'],np.memmap)
+    assert actual_output['hh_age'].dtype == np.float64
+    np.testing.assert_array_equal(actual_output['hh_age'],sfc_test['hh_age'])
+    # a second read reuses the cache
+    assert len(os.listdir(cache_dir)) == 1
+    actual_output = read_stata_cached(stata_path,['income_total'],cache_dir)
+    np.testing.assert_array_equal(actual_output['income_total'],sfc_test['income_total'])
+    # a new version of the file replaces the cache
+    sfc_test['hh_age'] = sfc_test['hh_age'] + 1
+    sfc_test.to_stata(stata_path,write_index=False)
+    actual_output = read_stata_cached(stata_path,['hh_age'],cache_dir)
+    np.testing.assert_array_equal(actual_output['hh_age'],sfc_test['hh_age'])
+    assert len(os.listdir(cache_dir)) == 1
+    with pytest.raises(ValueError):
+        read_stata_cached(stata_path,['wgt'],cache_dir)
+
+def test_read_stata_cached_many_columns(tmp_path):
+    mycolumns = [f'wt1b{r}' for r in range(1,301)]
+    sfc_test = pd.DataFrame(np.arange(5*300,dtype=np.float64).reshape(5,300),columns=mycolumns)
+    stata_path = str(tmp_path / "sfc_test.dta")
+    sfc_test.to_stata(stata_path,write_index=False)
+    soft_limit, hard_limit = resource.getrlimit(resource.RLIMIT_NOFILE)
+    resource.setrlimit(resource.RLIMIT_NOFILE,(min(128,soft_limit),hard_limit))
+    try:
+        actual_output = read_stata_cached(stata_path,mycolumns,str(tmp_path / "cache"),
+                                          mymemmap=False)
+    finally:
+        resource.setrlimit(resource.RLIMIT_NOFILE,(soft_limit,hard_limit))
+    assert list(actual_output) == mycolumns
+    np.testing.assert_array_equal(np.column_stack(list(actual_output.values())),sfc_test)
+
+
+def test_read_stata_chunks(tmp_path):
+    sfc_test = setup_mytest()
+    stata_path = str(tmp_path / "sfc_test.dta")
+    sfc_test.to_stata(stata_path,write_index=False)
+    actual_chunks = list(read_stata_chunks(stata_path,['hh_age'],2))
+    assert [len(chunk) for chunk in actual_chunks] == [2,2,1]
+    assert all(list(chunk) == ['hh_age'] for chunk in actual_chunks)
+    # small chunks give the same cache as a single one
+    actual_output = read_stata_cached(stata_path,['hh_age','net_worth'],str(tmp_path / "cache"),2)
+    np.testing.assert_array_equal(actual_output['hh_age'],sfc_test['hh_age'])
+    actual_chunks = list(iterate_chunks(actual_output,3))
+    np.testing.assert_array_equal(actual_chunks[1]['net_worth'],[4,5])
+
+def test_read_stata_varlist(tmp_path):
+    sfc_test = setup_mytest()
+    stata_path = str(tmp_path / "sfc_test.dta")
+    sfc_test.to_stata(stata_path,write_index=False)
+    assert read_stata_varlist(stata_path) == ['net_worth','income_total','hh_age','hh_weights']
+
+def test_write_artifact(tmp_path, monkeypatch):
+    sfc_test = setup_mytest()
+    sfc_test.index.name = 'hh_id'
+    artifact_path = str(tmp_path / "sfc_test.artifact")
+    monkeypatch.setattr(mystorage,'ARTIFACT_RECORDS_MAX_ROWS',3)
+    write_artifact(artifact_path,{'sfc_test':sfc_test,
+                                  'sfc_test_small':sfc_test.iloc[:2],
+                                  'hh_age':sfc_test['hh_age'].iloc[:2],
+                                  'lorenz':np.linspace(0,1,6),
+                                  'ginico':0.25})
+    header, _ = read_artifact_header(artifact_path)
+    assert [entry['kind'] for entry in header.values()] == ['columns','records','records',
+                                                            'array','scalar']
+    actual_output = read_artifact(artifact_path,['lorenz','ginico'])
+    assert list(actual_output) == ['lorenz','ginico']
+    assert isinstance(actual_output['lorenz'],np.memmap)
+    np.testing.assert_array_almost_equal(actual_output['lorenz'],np.linspace(0,1,6))
+    assert actual_output['ginico'] == 0.25
+    actual_output = read_artifact(artifact_path)
+    assert_frame_equal(actual_output['sfc_test'],sfc_test,check_index_type=False)
+    assert_frame_equal(actual_output['sfc_test_small'],sfc_test.iloc[:2],check_index_type=False)
+    assert_series_equal(actual_output['hh_age'],sfc_test['hh_age'].iloc[:2],check_index_type=False)
+    # an index with several levels, in both layouts
+    sfc_test.index = pd.MultiIndex.from_arrays([[1,1,2,2,3],[1,2,1,2,1]],
+                                               names=['hh_id','hh_implicate'])
+    write_artifact(artifact_path,{'sfc_test':sfc_test,'sfc_test_small':sfc_test.iloc[:2]})
+    actual_output = read_artifact(artifact_path)
+    assert_frame_equal(actual_output['sfc_test'],sfc_test)
+    assert_frame_equal(actual_output['sfc_test_small'],sfc_test.iloc[:2])
+
+def test_generate_sorted_view(tmp_path):
+    sfc_test = setup_mytest()
+    artifact_path = str(tmp_path / "sfc_test.artifact")
+    myorder = np.array([4,3,2,1,0])
+    write_artifact(artifact_path,{'sfc_test':sfc_test,
+                                  'sfc_test_sort':generate_sorted_view('sfc_test',myorder,
+                                      {'hh_age_bin':np.array([5,4,3,2,1])})})
+    header, _ = read_artifact_header(artifact_path)
+    assert header['sfc_test_sort']['order']['dtype'] == '<i4'
+    expected_output = sfc_test.iloc[myorder].copy()
+    expected_output['hh_age_bin'] = [5,4,3,2,1]
+    actual_output = read_artifact(artifact_path,['sfc_test_sort'])
+    assert list(actual_output) == ['sfc_test_sort']
+    assert_frame_equal(actual_output['sfc_test_sort'],expected_output,check_index_type=False)
+
+
+if __name__ == '__main__':
+    status = pytest.main([sys.argv[1]])
+    sys.exit(status)